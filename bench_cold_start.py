@@ -0,0 +1,79 @@
+# Cold-start benchmark for index.py
+# Every run starts a fresh interpreter and reports how long it takes
+# to import the module, to serve the first /help update and to create
+# the S3 client. Nothing goes to the network: /help is answered in the
+# webhook response and the S3 client is only constructed.
+#
+# Usage: python bench_cold_start.py [runs]
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+DUMMY_ENV = {
+    "ADMIN_HANDLER": "admin",
+    "GROUP_NAME": "group",
+    "BOT_TOKEN": "1:bench",
+    "S3_ACCESS_KEY_ID": "bench",
+    "S3_SECRET_ACCESS_KEY": "bench",
+    "S3_BUCKET_NAME": "bench",
+    "S3_ENDPOINT_URL": "http://localhost:9",
+    "S3_REGION": "us-east-1",
+    "WEBHOOK_REPLY_MODE": "true",
+}
+
+HELP_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "text": "/help",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+        "from": {"id": 1, "is_bot": False, "first_name": "bench",
+                 "username": "bench"},
+        "chat": {"id": 1, "type": "private"},
+    },
+}
+
+RUN_ONCE = f"""
+import json, time
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+index.handler({{'body': {json.dumps(json.dumps(HELP_UPDATE))}}}, None)
+handled = time.perf_counter()
+index.storage.storage_client
+connected = time.perf_counter()
+print(json.dumps({{
+    'import': imported - started,
+    'first_request': handled - imported,
+    's3_client': connected - handled,
+}}))
+"""
+
+
+def run_once():
+    env = {**os.environ, **DUMMY_ENV}
+    output = subprocess.run(
+        [sys.executable, "-c", RUN_ONCE],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    results = [run_once() for _ in range(runs)]
+
+    print(f"{runs} cold starts, milliseconds")
+    print(f"{'phase':<15}{'median':>10}{'min':>10}{'max':>10}")
+    for phase in ('import', 'first_request', 's3_client'):
+        timings = [r[phase] * 1000 for r in results]
+        print(f"{phase:<15}{statistics.median(timings):>10.1f}"
+              f"{min(timings):>10.1f}{max(timings):>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+# Load benchmark for index.handler
+# Webhook bodies are replayed through handler against in-process stand-ins
+# for the S3 client and the Telegram Bot API with injected latency. Bodies
+# are either synthetic (/played, /top, /book and /leave over a roster of
+# registered players) or recorded ones, one JSON body per line.
+# It reports invocations per second, latency percentiles and the S3
+# operations per command, and fails when a command exceeds its op budget.
+#
+# Usage: python bench_load.py [--roster 10 1000 10000] [--updates 500]
+#                             [--mix played=4,top=3,book=2,leave=1]
+#                             [--s3-latency 5] [--bot-latency 20]
+#                             [--concurrency 4] [--bodies recorded.jsonl]
+#                             [--budget top=4] [--check]
+# --check asserts the default OP_BUDGETS, --budget adds or overrides one.
+# Budgets are meant for sequential runs: with --concurrency conditional
+# writes conflict and their retries add operations.
+
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+DUMMY_ENV = {
+    "ADMIN_HANDLER": "admin",
+    "GROUP_NAME": "group",
+    "BOT_TOKEN": "1:bench",
+    "S3_ACCESS_KEY_ID": "bench",
+    "S3_SECRET_ACCESS_KEY": "bench",
+    "S3_BUCKET_NAME": "bench",
+    "S3_ENDPOINT_URL": "http://localhost:9",
+    "S3_REGION": "us-east-1",
+    "WEBHOOK_REPLY_MODE": "true",
+    "METRICS_LOG": "false",
+}
+for name, value in DUMMY_ENV.items():
+    os.environ.setdefault(name, value)
+
+import telebot
+from botocore.exceptions import ClientError
+
+import index
+
+S3_OPERATIONS = {'get_object', 'put_object', 'head_object', 'delete_object',
+                 'delete_objects', 'list_objects_v2'}
+# The most S3 operations a warm invocation of the command may make,
+# independent of the roster size
+OP_BUDGETS = {'top': 4, 'queue': 2, 'book': 5, 'leave': 5, 'played': 14}
+DEFAULT_MIX = 'played=4,top=3,book=2,leave=1'
+
+
+class FakeS3Client:
+    """
+    The subset of the S3 API the bot uses, with conditional requests
+    and paginated listings, sleeping latency seconds per call
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.version = 0
+
+    @staticmethod
+    def error(code, status):
+        return ClientError({'Error': {'Code': code},
+                            'ResponseMetadata': {'HTTPStatusCode': status}},
+                           'fake')
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        self.wait()
+        body = Body.encode() if isinstance(Body, str) else Body
+        with self.lock:
+            found = self.objects.get(Key)
+            if (IfNoneMatch == '*' and found) or (
+                    IfMatch and (not found or found[1] != IfMatch)):
+                raise self.error('PreconditionFailed', 412)
+            self.version += 1
+            etag = f'"{hashlib.md5(body + str(self.version).encode()).hexdigest()}"'
+            self.objects[Key] = (
+                body, etag, datetime.datetime.now(datetime.timezone.utc))
+        return {'ETag': etag}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.wait()
+        with self.lock:
+            found = self.objects.get(Key)
+        if not found:
+            raise self.error('NoSuchKey', 404)
+        body, etag, modified = found
+        if IfNoneMatch == etag:
+            raise self.error('304', 304)
+        return {'Body': io.BytesIO(body), 'ETag': etag, 'LastModified': modified}
+
+    def head_object(self, Bucket, Key):
+        self.wait()
+        with self.lock:
+            found = self.objects.get(Key)
+        if not found:
+            raise self.error('404', 404)
+        return {'ETag': found[1], 'LastModified': found[2],
+                'ContentLength': len(found[0])}
+
+    def delete_object(self, Bucket, Key):
+        self.wait()
+        with self.lock:
+            self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        self.wait()
+        with self.lock:
+            for deleted in Delete['Objects']:
+                self.objects.pop(deleted['Key'], None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000, StartAfter=None,
+                        ContinuationToken=None):
+        self.wait()
+        after = ContinuationToken or StartAfter or ''
+        with self.lock:
+            keys = sorted(key for key, found in self.objects.items()
+                          if key.startswith(Prefix) and key > after)
+            page = [{'Key': key, 'ETag': self.objects[key][1],
+                     'LastModified': self.objects[key][2]}
+                    for key in keys[:MaxKeys]]
+        response = {'KeyCount': len(page), 'IsTruncated': len(keys) > MaxKeys}
+        if page:
+            response['Contents'] = page
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]['Key']
+        return response
+
+
+class FakeBotApi:
+    """
+    Stand-in for the Bot API HTTP requests of telebot
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+
+    def __call__(self, method, url, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls[url.rsplit('/', 1)[-1]] += 1
+        return FakeResponse()
+
+
+class FakeResponse:
+    status_code = 200
+    reason = 'OK'
+    text = ''
+
+    def json(self):
+        return {'ok': True, 'result': {
+            'message_id': 1, 'date': 0, 'text': '',
+            'chat': {'id': 1, 'type': 'group'}}}
+
+
+class MetricsCollector(logging.Handler):
+    """
+    Keeps the per-invocation summaries the handler logs
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.summaries = []
+
+    def emit(self, record):
+        summary = json.loads(record.getMessage())
+        if 'command' in summary:
+            self.summaries.append(summary)
+
+
+def reset_state(s3_latency):
+    """
+    A fresh bucket and the in-process state of a fresh container
+    """
+    client = FakeS3Client(s3_latency)
+    index.storage.client = client
+    index.tenants.default = index.Tenant(index.storage)
+    index.tenants.groups.clear()
+    index.deduplicator.seen.clear()
+    return client
+
+
+def seed_roster(size):
+    now = int(time.time())
+    names = [f"player{i}" for i in range(size)]
+    ratings = index.tenants.default.ratings
+    index.storage.gather(*(
+        lambda name=name: ratings.set(name, index.START_RATING, 0, 0,
+                                      *index.rating_model.initial())
+        for name in names))
+    ratings.set_leaderboard(
+        {name: [index.START_RATING, 0, 0, now] for name in names})
+    return names
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        command, weight = part.split('=')
+        weights[command] = float(weight)
+    return weights
+
+
+def synthetic_bodies(names, count, mix, rng):
+    commands = list(mix)
+    for update_id in range(1, count + 1):
+        command = rng.choices(commands, weights=[mix[c] for c in commands])[0]
+        sender = rng.choice(names)
+        if command == 'played':
+            opponent = rng.choice([name for name in rng.sample(names, 2)
+                                   if name != sender])
+            a, b = rng.choice([(3, 0), (3, 1), (3, 2), (2, 3), (1, 3), (0, 3)])
+            text = f"/played @{opponent} {a}-{b}"
+        else:
+            text = f"/{command}"
+
+        yield json.dumps({'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0,
+                          'length': len(text.split()[0])}],
+            'from': {'id': update_id, 'is_bot': False,
+                     'first_name': sender, 'username': sender},
+            'chat': {'id': -1, 'type': 'group',
+                     'title': os.environ['GROUP_NAME']}}})
+
+
+def run(bodies, concurrency):
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda body: index.handler({'body': body}, None),
+                              bodies))
+    else:
+        for body in bodies:
+            index.handler({'body': body}, None)
+    return time.perf_counter() - started
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def summarize(summaries):
+    """
+    {command: {count, p50, p95, p99, s3_mean, s3_max, bot_api}}
+    """
+    by_command = {}
+    for summary in summaries:
+        by_command.setdefault(summary['command'], []).append(summary)
+
+    report = {}
+    for command, runs in sorted(by_command.items(), key=lambda item: str(item[0])):
+        wall = sorted(run['wall_ms'] for run in runs)
+        s3_ops = [sum(count for kind, count in run['counts'].items()
+                      if kind in S3_OPERATIONS) for run in runs]
+        report[command] = {
+            'count': len(runs),
+            'p50': percentile(wall, 0.5),
+            'p95': percentile(wall, 0.95),
+            'p99': percentile(wall, 0.99),
+            's3_mean': statistics.mean(s3_ops),
+            's3_max': max(s3_ops),
+            'bot_api': statistics.mean(
+                run['counts'].get('bot_api', 0) for run in runs),
+        }
+    return report
+
+
+def check_budgets(report, budgets):
+    """
+    Commands whose warm invocations made more S3 operations than allowed
+    """
+    return [f"{command}: {report[command]['s3_max']} S3 ops > {budget}"
+            for command, budget in budgets.items()
+            if command in report and report[command]['s3_max'] > budget]
+
+
+def print_report(roster, report, invocations, elapsed):
+    print(f"roster {roster}: {invocations} invocations in {elapsed:.2f}s, "
+          f"{invocations / elapsed:.1f}/s")
+    print(f"{'command':<12}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'s3 mean':>9}{'s3 max':>8}{'bot api':>9}")
+    for command, row in report.items():
+        print(f"{str(command):<12}{row['count']:>7}{row['p50']:>9.1f}"
+              f"{row['p95']:>9.1f}{row['p99']:>9.1f}{row['s3_mean']:>9.2f}"
+              f"{row['s3_max']:>8}{row['bot_api']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--roster', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--s3-latency', type=float, default=0,
+                        help='milliseconds per S3 call')
+    parser.add_argument('--bot-latency', type=float, default=0,
+                        help='milliseconds per Bot API call')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--bodies')
+    parser.add_argument('--budget', action='append', default=[])
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    budgets = dict(OP_BUDGETS) if args.check else {}
+    for budget in args.budget:
+        command, limit = budget.split('=')
+        budgets[command] = int(limit)
+
+    collector = MetricsCollector()
+    index.metrics_log.addHandler(collector)
+    index.metrics_log.setLevel(logging.INFO)
+    index.metrics_log.propagate = False
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = FakeBotApi(args.bot_latency / 1000)
+
+    violations = []
+    for roster in args.roster:
+        client = reset_state(0)
+        names = seed_roster(roster)
+        client.latency = args.s3_latency / 1000
+
+        if args.bodies:
+            with open(args.bodies) as recorded:
+                bodies = [line.strip() for line in recorded if line.strip()]
+        else:
+            bodies = list(synthetic_bodies(
+                names, args.warmup + args.updates, parse_mix(args.mix),
+                random.Random(args.seed)))
+
+        run(bodies[:args.warmup], 1)
+        collector.summaries = []
+        elapsed = run(bodies[args.warmup:], args.concurrency)
+
+        report = summarize(collector.summaries)
+        print_report(roster, report, len(collector.summaries), elapsed)
+        violations += [f"roster {roster}, {violation}"
+                       for violation in check_budgets(report, budgets)]
+        print()
+
+    for violation in violations:
+        print(f"Over budget: {violation}")
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()
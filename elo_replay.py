@@ -0,0 +1,333 @@
+# Offline replay of the match history with the bot's Elo formula
+# Games are grouped into chronological batches where nobody plays twice,
+# every batch is applied to all players at once with numpy, and a grid of
+# parameters is replayed in the same pass as extra rows of the arrays.
+#
+# Usage: python elo_replay.py [--history events.jsonl]
+#                             [--multiplier 20 30 40] [--score-base 0.1]
+#                             [--score-step 0.1 0.2] [--write]
+#                             [--group CHAT_ID]
+#                             [--model glicko2] [--period-days 7]
+# Without --history the events are read from the bot's bucket
+# (RATINGS_STORAGE_MODE=events) and the replay starts from the ratings the
+# log was seeded with. Admin set and delete events are applied in log
+# order, so /set_score corrections survive. --write stores the ratings of the first
+# parameter set back, keeping everyone's W/L. --group picks one of the
+# GROUP_IDS groups instead of the default one.
+# --model and --period-days replay with a rating model in rating periods:
+# all games of a period are rated in one batch, without --period-days
+# every game is a period of its own like in the bot.
+
+import argparse
+import itertools
+import json
+from collections import namedtuple
+
+import numpy as np
+
+import index
+
+Replay = namedtuple(
+    'Replay', ['players', 'params', 'ratings', 'trajectories', 'expected',
+               'states'], defaults=[None])
+
+
+def read_matches(events):
+    """
+    (name_1, name_2, a, b) of the played events in the given order
+    """
+    return [(*event['players'], *event['score'])
+            for event in events if event['type'] == 'played']
+
+
+def read_resets(events):
+    """
+    {game: [(name, rating, state)]} of the set and delete events, keyed by
+    the number of played events before them, so they are applied in log
+    order. A deleted player starts over: rating and state are None
+    """
+    resets = {}
+    games = 0
+    for event in events:
+        if event['type'] == 'played':
+            games += 1
+        elif event['type'] == 'set':
+            resets.setdefault(games, []).append(
+                (event['name'], event['stats'][0], event.get('state')))
+        elif event['type'] == 'delete':
+            resets.setdefault(games, []).append((event['name'], None, None))
+    return resets
+
+
+def initial_players(ratings):
+    """
+    {name: (rating, *state)} the event log starts from: the players
+    seeded into its first snapshot from the per-player objects
+    """
+    return {name: (values[0], *values[4:])
+            for name, values in ratings.initial_state()['players'].items()}
+
+
+def load_events(storage, events_dir):
+    keys = [key['Key'] for key in storage.list(events_dir)]
+    return [json.loads(body) for body in storage.get_many(keys) if body]
+
+
+def load_matches(storage, events_dir):
+    return read_matches(load_events(storage, events_dir))
+
+
+def read_periods(events, period_seconds):
+    """
+    Matches of the played events grouped into rating periods by their time,
+    with no period every game is a period of its own
+    """
+    periods = []
+    last_period = None
+    for event in events:
+        if event['type'] != 'played':
+            continue
+        period = event['ts'] // period_seconds if period_seconds else None
+        if period is None or period != last_period:
+            periods.append([])
+        periods[-1].append((*event['players'], *event['score']))
+        last_period = period
+    return periods
+
+
+def plan_batches(game_players):
+    """
+    Split games into consecutive batches where every player appears once.
+    A game goes right after the latest batch of either of its players,
+    so each player's games keep their order
+    """
+    last_batch = {}
+    batches = []
+    for game, players in enumerate(game_players):
+        batch = 1 + max(last_batch.get(player, -1) for player in players)
+        if batch == len(batches):
+            batches.append([])
+        batches[batch].append(game)
+        for player in players:
+            last_batch[player] = batch
+    return [np.array(batch) for batch in batches]
+
+
+def parameter_grid(multipliers, score_bases, score_steps):
+    return np.array(list(itertools.product(
+        multipliers, score_bases, score_steps)), dtype=float)
+
+
+def replay(matches, params=None, start_rating=index.START_RATING,
+           initial=None, resets=None):
+    """
+    Ratings after every game for each (multiplier, score_base, score_step)
+    row of params. trajectories[p, g] holds both players' ratings after
+    the game g and expected[p, g] the first player's expected score before it.
+    Players start from their initial ratings, resets of read_resets
+    are applied before the games they precede
+    """
+    if params is None:
+        params = parameter_grid([index.ELO_MULTIPLIER],
+                                [index.GAME_SCORE_BASE],
+                                [index.GAME_SCORE_STEP])
+    initial = initial or {}
+    resets = resets or {}
+
+    players = sorted({name for match in matches for name in match[:2]} |
+                     set(initial) |
+                     {reset[0] for batch in resets.values() for reset in batch})
+    ids = {name: i for i, name in enumerate(players)}
+    first = np.array([ids[match[0]] for match in matches], dtype=int)
+    second = np.array([ids[match[1]] for match in matches], dtype=int)
+    scores = np.array([match[2:] for match in matches], dtype=int).reshape(-1, 2)
+
+    multiplier, score_base, score_step = (
+        params[:, column, None] for column in range(3))
+    ratings = np.full((len(params), len(players)), float(start_rating))
+    for name, (rating, *_) in initial.items():
+        ratings[:, ids[name]] = rating
+    trajectories = np.zeros((len(params), len(matches), 2))
+    expected = np.zeros((len(params), len(matches)))
+
+    # Games and resets in log order, a reset occupies its player like a game
+    steps = []
+    for game in range(len(matches) + 1):
+        steps.extend((None, name, rating)
+                     for name, rating, _ in resets.get(game, []))
+        if game < len(matches):
+            steps.append((game, None, None))
+    step_players = [(first[game], second[game]) if game is not None
+                    else (ids[name],) for game, name, _ in steps]
+
+    for step_batch in plan_batches(step_players):
+        for game, name, rating in (steps[step] for step in step_batch):
+            if game is None:
+                ratings[:, ids[name]] = start_rating if rating is None else rating
+        batch = np.array([steps[step][0] for step in step_batch
+                          if steps[step][0] is not None], dtype=int)
+        if not len(batch):
+            continue
+
+        rating_1 = ratings[:, first[batch]]
+        rating_2 = ratings[:, second[batch]]
+        new_rating_1, new_rating_2 = index.elo_update(
+            rating_1, rating_2, scores[batch, 0], scores[batch, 1],
+            multiplier, score_base, score_step)
+
+        ratings[:, first[batch]] = np.trunc(new_rating_1)
+        ratings[:, second[batch]] = np.trunc(new_rating_2)
+        trajectories[:, batch, 0] = ratings[:, first[batch]]
+        trajectories[:, batch, 1] = ratings[:, second[batch]]
+        expected[:, batch] = index.expected_score(rating_1, rating_2)
+
+    return Replay(players, params, ratings.astype(int), trajectories, expected)
+
+
+def replay_periods(periods, model, start_rating=index.START_RATING,
+                   rate_idle=True, initial=None, resets=None):
+    """
+    Ratings and model states after applying every period in one batch.
+    Without rate_idle only the players of a period are rated, like the bot
+    does for the single game periods. Players start from their initial
+    (rating, *state), resets of read_resets preceding any game of
+    a period are applied before it
+    """
+    initial = initial or {}
+    resets = resets or {}
+    players = sorted({name for period in periods
+                      for match in period for name in match[:2]} |
+                     set(initial) |
+                     {reset[0] for batch in resets.values() for reset in batch})
+    ids = {name: i for i, name in enumerate(players)}
+    ratings = np.full(len(players), float(start_rating))
+    states = np.tile(np.array(model.initial(), dtype=float), (len(players), 1))
+    for name, (rating, *state) in initial.items():
+        ratings[ids[name]] = rating
+        if len(state) == states.shape[1]:
+            states[ids[name]] = state
+
+    def apply_resets(games):
+        for name, rating, state in resets.get(games, []):
+            ratings[ids[name]] = start_rating if rating is None else rating
+            # Like in the bot, a set without the model's state starts it over
+            states[ids[name]] = (state if state and len(state) == states.shape[1]
+                                 else model.initial())
+
+    games = 0
+    for period in periods:
+        for game in range(games, games + len(period)):
+            apply_resets(game)
+        games += len(period)
+
+        first = np.array([ids[match[0]] for match in period], dtype=int)
+        second = np.array([ids[match[1]] for match in period], dtype=int)
+        scores = np.array([match[2:] for match in period], dtype=int)
+        if rate_idle:
+            ratings, states = model.rate_period(
+                ratings, states, first, second, scores)
+            continue
+
+        rated, indices = np.unique(np.concatenate([first, second]),
+                                   return_inverse=True)
+        ratings[rated], states[rated] = model.rate_period(
+            ratings[rated], states[rated],
+            indices[:len(period)], indices[len(period):], scores)
+
+    apply_resets(games)
+    return Replay(players, None, ratings[None, :].astype(int), None, None, states)
+
+
+def brier_scores(result, matches):
+    """
+    How well each parameter set predicted the winners, lower is better
+    """
+    first_won = np.array([match[2] > match[3] for match in matches], dtype=float)
+    return ((result.expected - first_won) ** 2).mean(axis=1)
+
+
+def write_back(ratings, result, param_index=0):
+    """
+    Store the replayed ratings of the registered players, keeping their W/L
+    """
+    current = ratings.get_leaderboard() or ratings.rebuild_leaderboard()
+    updates = {
+        name: (int(result.ratings[param_index, i]), *current[name][1:3], None)
+        for i, name in enumerate(result.players) if name in current}
+    states = {name: result.states[i] if result.states is not None else ()
+              for i, name in enumerate(result.players)}
+
+    ratings.storage.gather(*(
+        lambda name=name, values=values: ratings.set(
+            name, *values[:3], *states[name])
+        for name, values in updates.items()))
+    ratings.update_leaderboard(updates)
+    return updates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history')
+    parser.add_argument('--multiplier', type=float, nargs='+',
+                        default=[index.ELO_MULTIPLIER])
+    parser.add_argument('--score-base', type=float, nargs='+',
+                        default=[index.GAME_SCORE_BASE])
+    parser.add_argument('--score-step', type=float, nargs='+',
+                        default=[index.GAME_SCORE_STEP])
+    parser.add_argument('--write', action='store_true')
+    parser.add_argument('--group', type=int)
+    parser.add_argument('--model', choices=sorted(index.RATING_MODELS))
+    parser.add_argument('--period-days', type=float, default=0)
+    args = parser.parse_args()
+    tenant = index.tenants.get(args.group)
+
+    initial = None
+    if args.history:
+        with open(args.history) as history:
+            events = [json.loads(line) for line in history if line.strip()]
+    else:
+        events = load_events(index.storage, tenant.ratings.events_dir)
+        initial = initial_players(tenant.ratings)
+    resets = read_resets(events)
+
+    if args.model or args.period_days:
+        model = index.RATING_MODELS[args.model or index.RATING_MODEL]()
+        periods = read_periods(events, int(args.period_days * 24 * 60 * 60))
+        result = replay_periods(periods, model, rate_idle=bool(args.period_days),
+                                initial=initial, resets=resets)
+
+        print(f"{sum(map(len, periods))} games in {len(periods)} periods, "
+              f"{len(result.players)} players")
+        for i in np.argsort(-result.ratings[0]):
+            state = " ".join(f"{value:g}" for value in result.states[i])
+            print(f"{result.players[i]:>20} {result.ratings[0, i]:>6} {state}")
+
+        if args.write:
+            updates = write_back(tenant.ratings, result)
+            print(f"Wrote {len(updates)} ratings")
+        return
+
+    matches = read_matches(events)
+
+    params = parameter_grid(args.multiplier, args.score_base, args.score_step)
+    result = replay(matches, params, initial=initial, resets=resets)
+    brier = brier_scores(result, matches)
+
+    print(f"{len(matches)} games, {len(result.players)} players")
+    print(f"{'multiplier':>10}{'base':>8}{'step':>8}{'brier':>8}  top")
+    for p in np.argsort(brier):
+        top = np.argsort(-result.ratings[p])[:3]
+        top_repr = ", ".join(
+            f"{result.players[i]}={result.ratings[p, i]}" for i in top)
+        print(f"{params[p, 0]:>10g}{params[p, 1]:>8g}{params[p, 2]:>8g}"
+              f"{brier[p]:>8.4f}  {top_repr}")
+
+    if args.write:
+        updates = write_back(tenant.ratings, result)
+        print(f"Wrote {len(updates)} ratings "
+              f"with multiplier={params[0, 0]:g}, base={params[0, 1]:g}, "
+              f"step={params[0, 2]:g}")
+
+
+if __name__ == '__main__':
+    main()
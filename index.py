@@ -2,18 +2,37 @@
 # Happy that was copied from 
 # https://github.com/blazerer/pingEloBot
 
+import base64
+import gzip
 import json
 import os
 import logging
 import re
-import boto3
+import random
+import sqlite3
+import struct
+import threading
 import telebot
-import numpy as np
 import datetime
+import time
+import contextlib
+import contextvars
+import functools
+import sys
+import uuid
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 ADMIN_HANDLER = os.getenv("ADMIN_HANDLER")
 GROUP_NAME = os.getenv("GROUP_NAME")
+GROUP_IDS = {int(group) for group in os.getenv("GROUP_IDS", "").split(",")
+             if group.strip()}
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+WEBHOOK_REPLY_MODE = os.getenv("WEBHOOK_REPLY_MODE", "false").lower() == "true"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+RATING_MODEL = os.getenv("RATING_MODEL", "elo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "elo_bot.sqlite3")
 S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
 S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
@@ -29,145 +48,1578 @@ if (GROUP_NAME is None):
 if (BOT_TOKEN is None):
     raise Exception("BOT_TOKEN is required")
 
-if (S3_ACCESS_KEY_ID is None):
-    raise Exception("S3_ACCESS_KEY_ID is required")
+if STORAGE_BACKEND not in ('s3', 'sqlite', 'memory'):
+    raise Exception("STORAGE_BACKEND should be one of s3, sqlite, memory")
 
-if (S3_SECRET_ACCESS_KEY is None):
-    raise Exception("S3_SECRET_ACCESS_KEY is required")
+if RATING_MODEL not in ('elo', 'glicko2'):
+    raise Exception("RATING_MODEL should be one of elo, glicko2")
 
-if (S3_BUCKET_NAME is None):
-    raise Exception("S3_BUCKET_NAME is required")
+if STORAGE_BACKEND == 's3':
+    if (S3_ACCESS_KEY_ID is None):
+        raise Exception("S3_ACCESS_KEY_ID is required")
 
-if (S3_ENDPOINT_URL is None):
-    raise Exception("S3_ENDPOINT_URL is required")
+    if (S3_SECRET_ACCESS_KEY is None):
+        raise Exception("S3_SECRET_ACCESS_KEY is required")
 
-if (S3_REGION is None):
-    raise Exception("S3_REGION is required")
+    if (S3_BUCKET_NAME is None):
+        raise Exception("S3_BUCKET_NAME is required")
+
+    if (S3_ENDPOINT_URL is None):
+        raise Exception("S3_ENDPOINT_URL is required")
+
+    if (S3_REGION is None):
+        raise Exception("S3_REGION is required")
 
 QUEUE_DIR = 'players_queue'
+QUEUE_KEY = 'queue'
+CONDITIONAL_UPDATE_RETRIES = 5
+# Every game rewrites the leaderboard, so its writes conflict the most
+LEADERBOARD_UPDATE_RETRIES = 20
 PLAYERS_DIR = 'players_stats'
 RIVALS_DIR = 'rivals_stats'
+RIVALS_INDEX_DIR = 'rivals_index'
+UPDATES_KEY = 'recent_updates'
+LEADERBOARD_KEY = 'leaderboard'
+EVENTS_DIR = 'match_events'
+EVENTS_SNAPSHOT_KEY = 'match_snapshot'
+VERSIONS_DIR = 'state_versions'
+GROUPS_DIR = 'groups'
+EXPORT_KEY = 'state_export'
+HISTORY_DIR = 'rating_history'
+SEASON_KEY = 'season'
+SEASONS_DIR = 'seasons'
+COLD_DIR = 'cold_players'
 START_RATING = 1000
 ELO_BASE = 10.0
 ELO_POWER_DENOMINATOR = 400.0
 ELO_MULTIPLIER = 40
+GAME_SCORE_BASE = 0.1
+GAME_SCORE_STEP = 0.2
 ACTIVE_TOP_DAYS = 14
+GLICKO_START_RD = 350.0
+GLICKO_START_VOLATILITY = 0.06
+GLICKO_TAU = 0.5
+GLICKO_SCALE = 173.7178
+GLICKO_EPSILON = 0.000001
+# (timestamp, rating, opponent id) of one rating change
+HISTORY_RECORD = struct.Struct('<IiI')
+HISTORY_TREND_GAMES = 10
+STORAGE_MAX_WORKERS = int(os.getenv("STORAGE_MAX_WORKERS", 8))
+RATINGS_CACHE_SIZE = int(os.getenv("RATINGS_CACHE_SIZE", 1024))
+RATINGS_STORAGE_MODE = os.getenv("RATINGS_STORAGE_MODE", "objects")
+EVENTS_COMPACT_EVERY = int(os.getenv("EVENTS_COMPACT_EVERY", 50))
+EVENTS_SETTLE_SECONDS = int(os.getenv("EVENTS_SETTLE_SECONDS", 30))
+RIVALS_STORAGE_MODE = os.getenv("RIVALS_STORAGE_MODE", "pairs")
+METRICS_LOG = os.getenv("METRICS_LOG", "true").lower() == "true"
+METRICS_HISTOGRAM_SIZE = int(os.getenv("METRICS_HISTOGRAM_SIZE", 1000))
+METRICS_SUMMARY_EVERY = int(os.getenv("METRICS_SUMMARY_EVERY", 0))
+RECENT_UPDATES_LOCAL = int(os.getenv("RECENT_UPDATES_LOCAL", 1000))
+RECENT_UPDATES_PERSISTED = int(os.getenv("RECENT_UPDATES_PERSISTED", 100))
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", 256))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 100))
+WARM_UP_FROM_EXPORT = os.getenv("WARM_UP_FROM_EXPORT", "false").lower() == "true"
+HISTORY_CHUNKS_READ = int(os.getenv("HISTORY_CHUNKS_READ", 2))
+COLD_AFTER_DAYS = int(os.getenv("COLD_AFTER_DAYS", 90))
+COLD_SHARDS = int(os.getenv("COLD_SHARDS", 16))
+DEADLINE_MARGIN_MS = int(os.getenv("DEADLINE_MARGIN_MS", 500))
+OPTIONAL_WORK_MIN_MS = int(os.getenv("OPTIONAL_WORK_MIN_MS", 500))
+WRITE_PHASE_MIN_MS = int(os.getenv("WRITE_PHASE_MIN_MS", 1000))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", 1))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", 2))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 3))
+BOT_API_TIMEOUT = float(os.getenv("BOT_API_TIMEOUT", 3))
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", 4))
+RATING_OF_PATTERN = re.compile(r"/rating_of @([a-zA-Z0-9_]+)")
+STATS_VS_PATTERN = re.compile(r"/stats_vs @([a-zA-Z0-9_]+)")
+PLAYED_PATTERN = re.compile(r"/played @([a-zA-Z0-9_]+) (\d+)-(\d+)")
+SET_SCORE_PATTERN = re.compile(r"/set_score @([a-zA-Z0-9_]+) (\d+) (\d+) (\d+)")
+PREDICT_PATTERN = re.compile(r"/predict @([a-zA-Z0-9_]+) @([a-zA-Z0-9_]+)")
+HISTORY_PATTERN = re.compile(r"/history @([a-zA-Z0-9_]+)")
+SET_STATS_VS_PATTERN = re.compile(
+    r"/set_stats_vs @([a-zA-Z0-9_]+) @([a-zA-Z0-9_]+) (\d+) (\d+)")
+MUTATING_COMMANDS = {
+    'register_me', 'delete_me', 'played', 'book', 'leave', 'clean_queue',
+    'set_score', 'set_stats_vs', 'rebuild_top', 'migrate_rivals',
+    'replay_ratings', 'import_state', 'close_season'}
+STATELESS_COMMANDS = {'help', 'start'}
+
+
+def expected_score(rating_a, rating_b):
+    return 1.0 / (1 + ELO_BASE ** ((rating_b - rating_a) / ELO_POWER_DENOMINATOR))
+
+
+def balanced_pairs(ratings):
+    """
+    Pair the players starting from the most even expected score.
+    Returns [(i, j, expected score of i against j)], an odd player is left out
+    """
+    import numpy as np
+
+    ratings = np.asarray(ratings, dtype=float)
+    expected = expected_score(ratings[:, None], ratings[None, :])
+    first, second = np.triu_indices(len(ratings), k=1)
+    order = np.argsort(np.abs(expected[first, second] - 0.5), kind='stable')
+
+    paired = set()
+    pairs = []
+    for i, j in zip(first[order], second[order]):
+        if i in paired or j in paired:
+            continue
+        paired.update((i, j))
+        pairs.append((int(i), int(j), float(expected[i, j])))
+        if len(paired) >= len(ratings) - 1:
+            break
+    return pairs
+
+
+def elo_update(rating_1, rating_2, a, b, multiplier=ELO_MULTIPLIER,
+               score_base=GAME_SCORE_BASE, score_step=GAME_SCORE_STEP):
+    """
+    Ratings after a game with the score a-b, before truncation.
+    The winner's actual score is amplified by the game score margin.
+    Works for numbers and numpy arrays alike
+    """
+    game_score_adjustment = score_base + abs(a - b) * score_step
+    sign = (a > b) * 2 - 1
+    adjustment_1 = 0.5 + sign * game_score_adjustment
+    adjustment_2 = 0.5 - sign * game_score_adjustment
 
+    return (
+        rating_1 + multiplier * (adjustment_1 - expected_score(rating_1, rating_2)),
+        rating_2 + multiplier * (adjustment_2 - expected_score(rating_2, rating_1)))
 
-class QueueInfo:
-    def __init__(self, storage_client, bucket_name, queue_dir):
-        self.storage_client = storage_client
+
+class EloModel:
+    """
+    The modified Elo: the winner's actual score is amplified
+    by the game score margin. Players have no state besides the rating
+    """
+
+    def initial(self):
+        return ()
+
+    def rate(self, player_1, player_2, a, b):
+        """
+        ((rating, *state), (rating, *state)) of both players after a game a-b
+        """
+        new_rating_1, new_rating_2 = elo_update(player_1[0], player_2[0], a, b)
+        return (int(new_rating_1),), (int(new_rating_2),)
+
+    def rate_period(self, ratings, states, first, second, scores):
+        """
+        Ratings and states of all players after a rating period. Every game
+        of the period is rated against the ratings at its start
+        """
+        import numpy as np
+
+        ratings = np.asarray(ratings, dtype=float)
+        new_rating_1, new_rating_2 = elo_update(
+            ratings[first], ratings[second], scores[:, 0], scores[:, 1])
+
+        deltas = np.zeros(len(ratings))
+        np.add.at(deltas, first, new_rating_1 - ratings[first])
+        np.add.at(deltas, second, new_rating_2 - ratings[second])
+        return np.trunc(ratings + deltas), np.asarray(states)
+
+
+class Glicko2Model:
+    """
+    Glicko-2: every player also has a rating deviation and a volatility.
+    All games of a rating period are rated at once, the live bot treats
+    every game as a period of its own
+    """
+
+    def __init__(self, tau=GLICKO_TAU):
+        self.tau = tau
+
+    def initial(self):
+        return (GLICKO_START_RD, GLICKO_START_VOLATILITY)
+
+    def rate(self, player_1, player_2, a, b):
+        import numpy as np
+
+        states = [player[1:] or self.initial() for player in (player_1, player_2)]
+        ratings, states = self.rate_period(
+            [player_1[0], player_2[0]], states,
+            np.array([0]), np.array([1]), np.array([[a, b]]))
+        return tuple((int(rating), *map(float, state))
+                     for rating, state in zip(ratings, states))
+
+    def volatility(self, delta, phi, v, sigma):
+        """
+        New volatilities by the Illinois algorithm, for all players at once
+        """
+        import numpy as np
+
+        a = np.log(sigma ** 2)
+
+        def f(x):
+            ex = np.exp(x)
+            return (ex * (delta ** 2 - phi ** 2 - v - ex) /
+                    (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / self.tau ** 2)
+
+        big = delta ** 2 > phi ** 2 + v
+        low = np.where(big, np.log(np.where(big, delta ** 2 - phi ** 2 - v, 1)),
+                       a - self.tau)
+        while (pending := ~big & (f(low) < 0)).any():
+            low = np.where(pending, low - self.tau, low)
+
+        high, f_high, f_low = a, f(a), f(low)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for _ in range(100):
+                active = np.abs(low - high) > GLICKO_EPSILON
+                if not active.any():
+                    break
+                middle = high + (high - low) * f_high / (f_low - f_high)
+                f_middle = f(middle)
+                swap = f_middle * f_low <= 0
+                high = np.where(active & swap, low, high)
+                f_high = np.where(active, np.where(swap, f_low, f_high / 2), f_high)
+                low = np.where(active, middle, low)
+                f_low = np.where(active, f_middle, f_low)
+        return np.exp(high / 2)
+
+    def rate_period(self, ratings, states, first, second, scores):
+        """
+        Ratings and (deviation, volatility) states of all players after
+        a rating period of the games first[i] vs second[i] with scores[i]
+        """
+        import numpy as np
+
+        states = np.asarray(states, dtype=float).reshape(-1, 2)
+        mu = (np.asarray(ratings, dtype=float) - START_RATING) / GLICKO_SCALE
+        phi = states[:, 0] / GLICKO_SCALE
+        sigma = states[:, 1]
+
+        players = np.concatenate([first, second])
+        opponents = np.concatenate([second, first])
+        first_won = (scores[:, 0] > scores[:, 1]).astype(float)
+        actual = np.concatenate([first_won, 1 - first_won])
+
+        g = 1 / np.sqrt(1 + 3 * phi[opponents] ** 2 / np.pi ** 2)
+        expected = 1 / (1 + np.exp(-g * (mu[players] - mu[opponents])))
+        v_inverse = np.zeros(len(mu))
+        np.add.at(v_inverse, players, g ** 2 * expected * (1 - expected))
+        improvement = np.zeros(len(mu))
+        np.add.at(improvement, players, g * (actual - expected))
+
+        played = v_inverse > 0
+        new_sigma = sigma.copy()
+        v = 1 / v_inverse[played]
+        new_sigma[played] = self.volatility(
+            v * improvement[played], phi[played], v, sigma[played])
+
+        phi_star = np.sqrt(phi ** 2 + new_sigma ** 2)
+        new_phi = np.where(
+            played, 1 / np.sqrt(1 / phi_star ** 2 + v_inverse), phi_star)
+        new_mu = mu + new_phi ** 2 * improvement
+
+        return (np.trunc(START_RATING + GLICKO_SCALE * new_mu),
+                np.stack([GLICKO_SCALE * new_phi, new_sigma], axis=1))
+
+
+RATING_MODELS = {'elo': EloModel, 'glicko2': Glicko2Model}
+
+
+class InvocationMetrics:
+    """
+    Wall time, storage operations, Bot API calls and cache hits
+    of one invocation
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.command = None
+        self.error = None
+        self.counts = Counter()
+        self.seconds = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, kind, seconds=None):
+        with self.lock:
+            self.counts[kind] += 1
+            if seconds is not None:
+                self.seconds[kind] += seconds
+
+    def summary(self):
+        return {
+            'command': self.command,
+            'wall_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'counts': dict(self.counts),
+            'ms': {kind: round(seconds * 1000, 1)
+                   for kind, seconds in self.seconds.items()},
+            'error': self.error,
+        }
+
+
+class LatencyHistogram:
+    """
+    The latest wall times per command, kept between warm invocations
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.timings = {}
+        self.observed = 0
+        self.lock = threading.Lock()
+
+    def observe(self, command, wall_ms):
+        with self.lock:
+            self.observed += 1
+            self.timings.setdefault(
+                command, deque(maxlen=self.size)).append(wall_ms)
+
+    def summary(self):
+        with self.lock:
+            timings = {command: sorted(values)
+                       for command, values in self.timings.items()}
+        return {
+            command: {'count': len(values),
+                      'p50': values[len(values) // 2],
+                      'p99': values[min(len(values) - 1,
+                                        len(values) * 99 // 100)]}
+            for command, values in timings.items()}
+
+
+current_metrics = contextvars.ContextVar('current_metrics', default=None)
+metrics_log = logging.getLogger('metrics')
+
+
+def record_metric(kind, seconds=None):
+    if metrics := current_metrics.get():
+        metrics.record(kind, seconds)
+
+
+def instrument(function):
+    """
+    Record the command and the time spent in the message handler
+    """
+    command = function.__name__.removesuffix('_handler')
+
+    @functools.wraps(function)
+    def wrapper(message):
+        if metrics := current_metrics.get():
+            metrics.command = command
+        started = time.perf_counter()
+        try:
+            return function(message)
+        finally:
+            record_metric('handler', time.perf_counter() - started)
+
+    return wrapper
+
+
+def emit_metrics(metrics):
+    summary = metrics.summary()
+    metrics_log.info(json.dumps(summary))
+
+    latency_histogram.observe(summary['command'], summary['wall_ms'])
+    if METRICS_SUMMARY_EVERY and (
+            latency_histogram.observed % METRICS_SUMMARY_EVERY == 0):
+        metrics_log.info(json.dumps({'latency': latency_histogram.summary()}))
+
+
+class PreconditionFailed(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    End of the invocation's time budget: the execution time the platform
+    has left minus a margin for returning the response
+    """
+
+    def __init__(self, seconds):
+        self.ends = time.monotonic() + seconds
+
+    @classmethod
+    def of(cls, context, margin_ms):
+        """
+        The deadline of a serverless invocation, None without a context
+        """
+        remaining = getattr(context, 'get_remaining_time_in_millis', None)
+        if remaining is None:
+            return None
+        return cls((remaining() - margin_ms) / 1000)
+
+    def remaining(self):
+        return self.ends - time.monotonic()
+
+    def timeout(self, limit):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return min(limit, remaining)
+
+
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+def call_timeout(limit):
+    """
+    Timeout of a call started now: limit cut down to the invocation's
+    remaining budget. Raises DeadlineExceeded once the budget is spent
+    """
+    if deadline := current_deadline.get():
+        return deadline.timeout(limit)
+    return limit
+
+
+def budget_allows(seconds):
+    deadline = current_deadline.get()
+    return deadline is None or deadline.remaining() >= seconds
+
+
+@contextlib.contextmanager
+def write_phase(seconds):
+    """
+    Writes of a mutation that have to land together. The budget is checked
+    once before they start, the calls inside aren't cut off by it halfway
+    """
+    if not budget_allows(seconds):
+        raise DeadlineExceeded()
+    token = current_deadline.set(None)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+class ObjectCache:
+    """
+    Size-bounded LRU of object bodies with their ETags,
+    kept between warm invocations
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def store(self, key, etag, body):
+        with self.lock:
+            self.entries[key] = (etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def evict(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_metric('cache_hit' if hit else 'cache_miss')
+
+    def stats(self):
+        return {'size': len(self.entries),
+                'hits': self.hits, 'misses': self.misses}
+
+
+class Storage:
+    """
+    Key-value storage of the bot's objects. Backends implement
+    get_versioned, put, delete and list, independent calls
+    can run concurrently on a bounded thread pool
+    """
+
+    player_index = False
+
+    def __init__(self, max_workers):
+        self.executor = (ThreadPoolExecutor(max_workers=max_workers)
+                         if max_workers else None)
+        self.worker_state = threading.local()
+
+    def get(self, key, cache=None):
+        return self.get_versioned(key)[0]
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def get_many(self, keys, cache=None):
+        return self.gather(
+            *(lambda key=key: self.get(key, cache) for key in keys))
+
+    def put_many(self, items, cache=None):
+        self.gather(*(lambda key=key, body=body: self.put(key, body, cache)
+                      for key, body in items))
+
+    def gather(self, *calls):
+        """
+        Run independent calls concurrently and return their results in order.
+        Calls made from a pool thread run inline so nested fan-outs can't
+        starve the pool
+        """
+        if (self.executor is None or len(calls) < 2 or
+                getattr(self.worker_state, 'active', False)):
+            return [call() for call in calls]
+
+        futures = [self.executor.submit(
+                       contextvars.copy_context().run, self._run_in_worker, call)
+                   for call in calls]
+        return [future.result() for future in futures]
+
+    def _run_in_worker(self, call):
+        self.worker_state.active = True
+        try:
+            return call()
+        finally:
+            self.worker_state.active = False
+
+
+class MemoryStorage(Storage):
+    """
+    Objects kept in a dict, for offline runs and load tests
+    """
+
+    def __init__(self):
+        super().__init__(max_workers=0)
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def get_versioned(self, key):
+        record_metric('get_object')
+        if (found := self.objects.get(key)) is None:
+            return None, None
+        return found[0], found[1]
+
+    def put(self, key, body, cache=None, if_match=None, if_none_match=None):
+        record_metric('put_object')
+        with self.lock:
+            etag = self.objects.get(key, (None, None))[1]
+            if (if_match and etag != if_match) or (if_none_match and etag):
+                raise PreconditionFailed(key)
+
+            etag = uuid.uuid4().hex
+            self.objects[key] = (
+                body, etag, datetime.datetime.now(datetime.timezone.utc))
+            return etag
+
+    def delete(self, key, cache=None):
+        record_metric('delete_object')
+        with self.lock:
+            self.objects.pop(key, None)
+
+    def list(self, prefix, start_after=None):
+        record_metric('list_objects_v2')
+        with self.lock:
+            return [{'Key': key, 'ETag': etag, 'LastModified': modified}
+                    for key, (_, etag, modified) in sorted(self.objects.items())
+                    if key.startswith(prefix) and key > (start_after or '')]
+
+
+class SQLiteStorage(Storage):
+    """
+    Objects kept in a SQLite database for self-hosted deployments.
+    Besides the objects table it keeps an indexed players table per group,
+    so the top is a query over the rating and last game columns
+    """
+
+    player_index = True
+
+    def __init__(self, path):
+        super().__init__(max_workers=0)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.tables = set()
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                "key TEXT PRIMARY KEY, body TEXT, etag TEXT, modified REAL)")
+
+    def players_table(self, group=None):
+        """
+        The quoted players table of the group, created on first use.
+        Call with the lock held
+        """
+        name = 'players' if group is None else f'players_{int(group)}'
+        if name not in self.tables:
+            with self.db:
+                self.db.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{name}" ('
+                    "name TEXT PRIMARY KEY, rating INTEGER, win INTEGER, "
+                    "lose INTEGER, last_game INTEGER)")
+                self.db.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{name}_by_rating" '
+                    f'ON "{name}" (rating DESC, win DESC, lose DESC, name DESC)')
+                self.db.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{name}_by_last_game" '
+                    f'ON "{name}" (last_game)')
+            self.tables.add(name)
+        return f'"{name}"'
+
+    def get_versioned(self, key):
+        record_metric('get_object')
+        with self.lock:
+            found = self.db.execute(
+                "SELECT body, etag FROM objects WHERE key = ?", (key,)).fetchone()
+        return found or (None, None)
+
+    def put(self, key, body, cache=None, if_match=None, if_none_match=None):
+        record_metric('put_object')
+        with self.lock, self.db:
+            found = self.db.execute(
+                "SELECT etag FROM objects WHERE key = ?", (key,)).fetchone()
+            etag = found[0] if found else None
+            if (if_match and etag != if_match) or (if_none_match and etag):
+                raise PreconditionFailed(key)
+
+            etag = uuid.uuid4().hex
+            self.db.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                (key, body, etag, time.time()))
+            return etag
+
+    def delete(self, key, cache=None):
+        record_metric('delete_object')
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE key = ?", (key,))
+
+    def delete_many(self, keys):
+        record_metric('delete_objects')
+        with self.lock, self.db:
+            self.db.executemany(
+                "DELETE FROM objects WHERE key = ?", [(key,) for key in keys])
+
+    def list(self, prefix, start_after=None):
+        record_metric('list_objects_v2')
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, etag, modified FROM objects "
+                "WHERE substr(key, 1, ?) = ? AND key > ? ORDER BY key",
+                (len(prefix), prefix, start_after or '')).fetchall()
+        return [{'Key': key, 'ETag': etag,
+                 'LastModified': datetime.datetime.fromtimestamp(
+                     modified, datetime.timezone.utc)}
+                for key, etag, modified in rows]
+
+    def get_players(self, group=None):
+        with self.lock:
+            table = self.players_table(group)
+            return {name: [rating, win, lose, last_game]
+                    for name, rating, win, lose, last_game in self.db.execute(
+                        f"SELECT * FROM {table}")}
+
+    def replace_players(self, players, group=None):
+        with self.lock, self.db:
+            table = self.players_table(group)
+            self.db.execute(f"DELETE FROM {table}")
+            self.db.executemany(
+                f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?)",
+                [(name, *values) for name, values in players.items()])
+
+    def update_players(self, updates, group=None):
+        """
+        Apply {name: (rating, win, lose, last_game) or None},
+        last_game=None keeps the previous value
+        """
+        with self.lock, self.db:
+            table = self.players_table(group)
+            for name, values in updates.items():
+                if values is None:
+                    self.db.execute(
+                        f"DELETE FROM {table} WHERE name = ?", (name,))
+                    continue
+
+                rating, win, lose, last_game = values
+                self.db.execute(
+                    f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET rating = excluded.rating, "
+                    "win = excluded.win, lose = excluded.lose, "
+                    "last_game = coalesce(?, last_game)",
+                    (name, int(rating), int(win), int(lose),
+                     last_game or 0, last_game))
+
+    def top_players(self, since, limit=None, group=None):
+        with self.lock:
+            table = self.players_table(group)
+            rows = self.db.execute(
+                f"SELECT name, rating, win, lose FROM {table} "
+                "WHERE last_game > ? "
+                "ORDER BY rating DESC, win DESC, lose DESC, name DESC "
+                "LIMIT ?", (since, -1 if limit is None else limit)).fetchall()
+        return [((rating, win, lose), name) for name, rating, win, lose in rows]
+
+
+class S3Storage(Storage):
+    """
+    Access to the bucket: paginated listings and concurrent GETs/PUTs
+    on a bounded thread pool sharing one boto3 client.
+    The client is created by client_factory on first use
+    """
+
+    def __init__(self, client_factory, bucket_name, max_workers):
+        super().__init__(max_workers)
+        self.client_factory = client_factory
+        self.client = None
+        self.client_lock = threading.Lock()
         self.bucket_name = bucket_name
-        self.queue_dir = queue_dir
+
+    @property
+    def storage_client(self):
+        if self.client is None:
+            with self.client_lock:
+                if self.client is None:
+                    self.client = self.client_factory()
+        return self.client
+
+    def call(self, operation, **kwargs):
+        # botocore has no per-request timeouts: the client's timeouts bound
+        # a call, the budget decides whether it's started at all
+        call_timeout(S3_READ_TIMEOUT)
+        started = time.perf_counter()
+        try:
+            return getattr(self.storage_client, operation)(
+                Bucket=self.bucket_name, **kwargs)
+        finally:
+            record_metric(operation, time.perf_counter() - started)
+
+    def get(self, key, cache=None):
+        """
+        Read the object body or None if it doesn't exist.
+        With a cache the stored copy is revalidated by its ETag
+        """
+        from botocore.exceptions import ClientError
+
+        cached = cache.lookup(key) if cache else None
+        conditions = {'IfNoneMatch': cached[0]} if cached else {}
+
+        try:
+            response = self.call('get_object', Key=key, **conditions)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if cached and code in ('304', 'NotModified'):
+                cache.count(hit=True)
+                return cached[1]
+            if code in ('NoSuchKey', '404'):
+                if cache:
+                    cache.evict(key)
+                    cache.count(hit=False)
+                return None
+            raise
+
+        body = response['Body'].read().decode()
+        if cache:
+            cache.store(key, response['ETag'], body)
+            cache.count(hit=False)
+        return body
+
+    def get_versioned(self, key):
+        """
+        Read the object body with its ETag or (None, None)
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.call('get_object', Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None, None
+            raise
+        return response['Body'].read().decode(), response['ETag']
+
+    def put(self, key, body, cache=None, if_match=None, if_none_match=None):
+        """
+        Write the object, optionally only if its ETag matches if_match
+        or, with if_none_match='*', only if it doesn't exist yet
+        """
+        from botocore.exceptions import ClientError
+
+        conditions = {}
+        if if_match:
+            conditions['IfMatch'] = if_match
+        if if_none_match:
+            conditions['IfNoneMatch'] = if_none_match
+
+        try:
+            response = self.call('put_object', Key=key, Body=body, **conditions)
+        except ClientError as e:
+            if e.response['Error']['Code'] in (
+                    'PreconditionFailed', 'ConditionalRequestConflict'):
+                raise PreconditionFailed(key)
+            raise
+
+        if cache:
+            cache.store(key, response['ETag'], body)
+        return response['ETag']
+
+    def delete(self, key, cache=None):
+        if cache:
+            cache.evict(key)
+        self.call('delete_object', Key=key)
+
+    def delete_many(self, keys):
+        for i in range(0, len(keys), 1000):
+            self.call('delete_objects',
+                      Delete={'Objects': [{'Key': key}
+                                          for key in keys[i:i + 1000]],
+                              'Quiet': True})
+
+    def list(self, prefix, start_after=None):
+        """
+        All objects under the prefix, following list_objects_v2 pagination
+        """
+        conditions = {'StartAfter': start_after} if start_after else {}
+        keys = []
+        while True:
+            page = self.call('list_objects_v2', Prefix=prefix, **conditions)
+            keys.extend(page.get('Contents', []))
+            if not page.get('IsTruncated'):
+                return keys
+            conditions = {'ContinuationToken': page['NextContinuationToken']}
+
+
+class UnitOfWork(Storage):
+    """
+    Storage wrapper for a batch of updates: every key is read once,
+    writes and deletes are kept in memory and flushed at the end,
+    so several updates touching the same object cost one PUT.
+    Conditional writes are checked against the batch's own versions,
+    the flush is conditional on the versions the batch has read
+    """
+
+    def __init__(self, storage):
+        super().__init__(max_workers=0)
+        self.storage = storage
+        self.player_index = storage.player_index
+        self.reads = {}
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def get_versioned(self, key):
+        with self.lock:
+            if key in self.writes:
+                body, etag, _ = self.writes[key]
+                return body, etag
+            if key in self.reads:
+                return self.reads[key]
+
+        found = self.storage.get_versioned(key)
+        with self.lock:
+            return self.reads.setdefault(key, found)
+
+    def get(self, key, cache=None):
+        with self.lock:
+            if key in self.writes:
+                return self.writes[key][0]
+            if key in self.reads:
+                return self.reads[key][0]
+
+        # Read with the ETag, later conditional writes of the batch need it
+        body, etag = self.storage.get_versioned(key)
+        if cache and body is not None:
+            cache.store(key, etag, body)
+        with self.lock:
+            return self.reads.setdefault(key, (body, etag))[0]
+
+    def put(self, key, body, cache=None, if_match=None, if_none_match=None):
+        if if_match or if_none_match:
+            _, etag = self.get_versioned(key)
+            if (if_match and etag != if_match) or (if_none_match and etag):
+                raise PreconditionFailed(key)
+
+        etag = uuid.uuid4().hex
+        with self.lock:
+            self.writes[key] = (body, etag, cache)
+        return etag
+
+    def delete(self, key, cache=None):
+        with self.lock:
+            self.writes[key] = (None, None, cache)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def list(self, prefix, start_after=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        keys = {key['Key']: key
+                for key in self.storage.list(prefix, start_after)}
+        with self.lock:
+            for key, (body, etag, _) in self.writes.items():
+                if not key.startswith(prefix) or key <= (start_after or ''):
+                    continue
+                if body is None:
+                    keys.pop(key, None)
+                else:
+                    keys[key] = {'Key': key, 'ETag': etag, 'LastModified': now}
+        return [keys[key] for key in sorted(keys)]
+
+    def gather(self, *calls):
+        return self.storage.gather(*calls)
+
+    def flush(self):
+        """
+        Write the batch back. The objects it has read are checked first,
+        if another writer changed one of them PreconditionFailed is raised
+        before anything is written, so the batch can be re-run on fresh
+        reads. The writes are conditional on the same versions
+        """
+        with self.lock:
+            writes, reads = self.writes, self.reads
+            self.writes, self.reads = {}, {}
+
+        read = [key for key in writes if key in reads]
+        current = self.storage.gather(*(
+            lambda key=key: self.storage.get_versioned(key)[1] for key in read))
+        for key, etag in zip(read, current):
+            if etag != reads[key][1]:
+                raise PreconditionFailed(key)
+
+        def write(key, body, cache):
+            if body is None:
+                return self.storage.delete(key, cache)
+            if key not in reads:
+                return self.storage.put(key, body, cache)
+            if etag := reads[key][1]:
+                return self.storage.put(key, body, cache, if_match=etag)
+            return self.storage.put(key, body, cache, if_none_match='*')
+
+        self.storage.gather(*(
+            lambda key=key, body=body, cache=cache: write(key, body, cache)
+            for key, (body, _, cache) in writes.items()))
+
+
+class QueueInfo:
+    """
+    The queue is a single document of [name, seq, mid, cid] entries
+    ordered by seq. Updates are conditional on the document's ETag
+    and retried on conflict
+    """
+
+    def __init__(self, storage, queue_key, legacy_queue_dir, update_retries):
+        self.storage = storage
+        self.queue_key = queue_key
+        self.legacy_queue_dir = legacy_queue_dir
+        self.update_retries = update_retries
+
+    def read(self):
+        body, etag = self.storage.get_versioned(self.queue_key)
+        if body is None:
+            return self.legacy_document(), None
+        return json.loads(body), etag
+
+    def legacy_document(self):
+        """
+        Build the document from the per-player objects of the old layout
+        """
+        keys = sorted(
+            (key['LastModified'], key['Key'])
+            for key in self.storage.list(f"{self.legacy_queue_dir}/"))
+        bodies = self.storage.get_many([key for (_, key) in keys])
+
+        players = []
+        for seq, ((_, key), body) in enumerate(zip(keys, bodies), start=1):
+            try:
+                mid, cid = (int(x) for x in body.split(','))
+                players.append([
+                    key.replace(f"{self.legacy_queue_dir}/", ''), seq, mid, cid])
+            except Exception as e:
+                pass
+
+        return {'seq': len(keys), 'players': players,
+                'legacy_keys': [key for (_, key) in keys]}
+
+    def update(self, modify):
+        """
+        Apply modify(document) -> (result, changed) and write the document
+        if it changed, retrying when someone else updated it first
+        """
+        for _ in range(self.update_retries):
+            document, etag = self.read()
+            legacy_keys = document.pop('legacy_keys', [])
+            result, changed = modify(document)
+            if not changed:
+                return result
+
+            try:
+                if etag:
+                    self.storage.put(self.queue_key, json.dumps(document),
+                                     if_match=etag)
+                else:
+                    self.storage.put(self.queue_key, json.dumps(document),
+                                     if_none_match='*')
+            except PreconditionFailed:
+                continue
+
+            if legacy_keys:
+                self.storage.delete_many(legacy_keys)
+            return result
+
+        raise Exception("The queue is being updated too often, try again")
 
     def book_table(self, name, mid, cid):
-        self.storage_client.put_object(
-            Bucket=self.bucket_name,
-            Key=f"{self.queue_dir}/{name}", Body=f"{mid},{cid}")
+        """
+        Returns the waiting list after booking and whether the name was added
+        """
+        def modify(document):
+            names = [entry[0] for entry in document['players']]
+            if name in names:
+                return (names, False), False
+
+            document['seq'] += 1
+            document['players'].append([name, document['seq'], mid, cid])
+            return (names + [name], True), True
+
+        return self.update(modify)
 
     def leave_table(self, name):
-        try:
-            self.storage_client.delete_object(
-                Bucket=self.bucket_name, Key=f"{self.queue_dir}/{name}")
-        except Exception as e:
-            pass
+        """
+        Returns the waiting list before leaving and (name, mid, cid)
+        of the next player if the leaving one was playing
+        """
+        def modify(document):
+            names = [entry[0] for entry in document['players']]
+            if name not in names:
+                return (names, None), False
+
+            position = names.index(name)
+            document['players'].pop(position)
+            next_booking = None
+            if position == 0 and document['players']:
+                next_name, _, mid, cid = document['players'][0]
+                next_booking = (next_name, mid, cid)
+            return (names, next_booking), True
+
+        return self.update(modify)
+
+    def clean(self):
+        """
+        Returns the waiting list before cleaning
+        """
+        def modify(document):
+            names = [entry[0] for entry in document['players']]
+            document['players'] = []
+            return names, bool(names)
+
+        return self.update(modify)
 
     def get_booking_info(self, name):
         try:
-            booking_info = self.storage_client.get_object(
-                Bucket=self.bucket_name,
-                Key=f"{self.queue_dir}/{name}")['Body'].read().decode('utf-8')
-            mid, cid = (int(x) for x in booking_info.split(','))
-            return (mid, cid)
+            for entry_name, _, mid, cid in self.read()[0]['players']:
+                if entry_name == name:
+                    return (mid, cid)
+            return None
         except Exception as e:
             return None
 
     def waiting_list(self):
         try:
-            response = self.storage_client.list_objects(
-                Bucket=self.bucket_name, Prefix=self.queue_dir)
-            if 'Contents' not in response:
-                return []
-
-            keys = [
-                (
-                    key['LastModified'],
-                    key['Key'].replace(f"{self.queue_dir}/", ''))
-                for key in response['Contents']
-                if key['Key'] != f"{self.queue_dir}/"]
-            return [handler for (_, handler) in sorted(keys)]
+            return [entry[0] for entry in self.read()[0]['players']]
+        except Exception as e:
+            return None
+
+
+class RatingHistory:
+    """
+    Every player's rating changes as fixed-width HISTORY_RECORDs in
+    per-month (UTC) chunks. Records are only appended to the current
+    month's chunk, older chunks are never rewritten
+    """
+
+    def __init__(self, storage, history_dir, chunks_read, update_retries):
+        self.storage = storage
+        self.history_dir = history_dir
+        self.chunks_read = chunks_read
+        self.update_retries = update_retries
+
+    @staticmethod
+    def opponent_id(name):
+        return zlib.crc32(name.encode()) if name else 0
+
+    def chunk_key(self, name, ts):
+        month = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+        return f"{self.history_dir}/{name}/{month:%Y-%m}"
+
+    def append(self, name, rating, opponent=None, ts=None):
+        ts = int(time.time()) if ts is None else ts
+        self.extend(name, [(ts, rating, opponent)])
+
+    def extend(self, name, records):
+        """
+        Append (timestamp, rating, opponent) records, every chunk
+        is read and written once
+        """
+        chunks = {}
+        for ts, rating, opponent in records:
+            chunks.setdefault(self.chunk_key(name, ts), []).append(
+                HISTORY_RECORD.pack(ts, int(rating), self.opponent_id(opponent)))
+        for key, packed in chunks.items():
+            self.append_chunk(key, b''.join(packed))
+
+    def append_chunk(self, key, records):
+        for _ in range(self.update_retries):
+            body, etag = self.storage.get_versioned(key)
+            chunk = (base64.b64decode(body) if body else b'') + records
+            try:
+                if etag:
+                    self.storage.put(key, base64.b64encode(chunk).decode(),
+                                     if_match=etag)
+                else:
+                    self.storage.put(key, base64.b64encode(chunk).decode(),
+                                     if_none_match='*')
+                return
+            except PreconditionFailed:
+                continue
+
+    def recent(self, name):
+        """
+        (timestamp, rating, opponent id) records of the newest chunks, oldest
+        first. Records appended twice by concurrent compactions are dropped
+        """
+        keys = [key['Key'] for key in
+                self.storage.list(f"{self.history_dir}/{name}/")]
+        bodies = self.storage.get_many(keys[-self.chunks_read:])
+        chunk = b''.join(base64.b64decode(body) for body in bodies if body)
+        return self.ordered(HISTORY_RECORD.iter_unpack(chunk))
+
+    @staticmethod
+    def ordered(records):
+        """
+        The records without repeats, by timestamp and then in append order
+        """
+        return sorted(dict.fromkeys(records), key=lambda record: record[0])
+
+    @staticmethod
+    def percentile(ratings, share):
+        ordered = sorted(ratings)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+class UpdateDeduplicator:
+    """
+    Remembers recent update_ids to acknowledge Telegram's webhook retries
+    without running the handlers again. Updates of mutating commands are
+    also claimed in a persisted record of recent ids of their tenant, so
+    a retry that lands on another container is caught too. Updates whose
+    handlers failed are forgotten, so their retries run again
+    """
+
+    def __init__(self, storage, updates_key, local_size, persisted_size,
+                 update_retries):
+        self.storage = storage
+        self.updates_key = updates_key
+        self.local_size = local_size
+        self.persisted_size = persisted_size
+        self.update_retries = update_retries
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def remember(self, update_id):
+        """
+        Returns False if the update was seen by this container already
+        """
+        with self.lock:
+            if update_id in self.seen:
+                return False
+            self.seen[update_id] = True
+            while len(self.seen) > self.local_size:
+                self.seen.popitem(last=False)
+            return True
+
+    def claim(self, key, update_ids):
+        """
+        Returns the ids that weren't claimed by anyone before
+        """
+        for _ in range(self.update_retries):
+            body, etag = self.storage.get_versioned(key)
+            ids = json.loads(body)['ids'] if body else []
+            claimed = [
+                update_id for update_id in update_ids
+                if update_id not in ids and not (
+                    len(ids) >= self.persisted_size and update_id < ids[0])]
+            if not claimed:
+                return set()
+
+            ids = sorted(ids + claimed)[-self.persisted_size:]
+            try:
+                if etag:
+                    self.storage.put(key, json.dumps({'ids': ids}),
+                                     if_match=etag)
+                else:
+                    self.storage.put(key, json.dumps({'ids': ids}),
+                                     if_none_match='*')
+                return set(claimed)
+            except PreconditionFailed:
+                continue
+
+        return set(update_ids)
+
+    def release(self, key, update_ids):
+        for _ in range(self.update_retries):
+            body, etag = self.storage.get_versioned(key)
+            ids = json.loads(body)['ids'] if body else []
+            if not set(ids).intersection(update_ids):
+                return
+
+            ids = [update_id for update_id in ids if update_id not in update_ids]
+            try:
+                self.storage.put(key, json.dumps({'ids': ids}), if_match=etag)
+                return
+            except PreconditionFailed:
+                continue
+
+    def mutating_ids(self, updates):
+        """
+        {record key: ids} of the mutating updates among (update, tenant) pairs
+        """
+        ids = {}
+        for update, tenant in updates:
+            if command_of(update) in MUTATING_COMMANDS:
+                ids.setdefault(f"{tenant.prefix}{self.updates_key}", []).append(
+                    update['update_id'])
+        return ids
+
+    def new_updates(self, updates):
+        """
+        The (update, tenant) pairs that weren't seen or claimed before
+        """
+        updates = [(update, tenant) for update, tenant in updates
+                   if self.remember(update['update_id'])]
+        claimed = set().union(*self.storage.gather(*(
+            lambda key=key, ids=ids: self.claim(key, ids)
+            for key, ids in self.mutating_ids(updates).items())))
+        return [(update, tenant) for update, tenant in updates
+                if update['update_id'] in claimed or
+                command_of(update) not in MUTATING_COMMANDS]
+
+    def forget(self, updates):
+        """
+        Drop the (update, tenant) pairs from the local and persisted records
+        """
+        with self.lock:
+            for update, _ in updates:
+                self.seen.pop(update['update_id'], None)
+        try:
+            self.storage.gather(*(
+                lambda key=key, ids=ids: self.release(key, ids)
+                for key, ids in self.mutating_ids(updates).items()))
+        except Exception as e:
+            logging.error(f'{e=}')
+
+
+def command_of(update):
+    """
+    The command of a raw update, like 'played' for "/played@bot @someone 3-1"
+    """
+    text = (update.get('message') or {}).get('text') or ''
+    if not text.startswith('/'):
+        return None
+    return text.split()[0][1:].split('@')[0]
+
 
+class ReplyCache:
+    """
+    Rendered replies of read-only commands. A reply is valid while the
+    version object of its scope ('ratings' or 'queue') stays the same,
+    mutating handlers bump it. A repeated query costs one conditional GET
+    of the version instead of rendering the reply from storage
+    """
+
+    def __init__(self, storage, versions_dir, max_size):
+        self.storage = storage
+        self.versions_dir = versions_dir
+        self.versions = ObjectCache(max_size)
+        self.replies = ObjectCache(max_size)
+
+    def version(self, scope):
+        try:
+            return self.storage.get(f"{self.versions_dir}/{scope}", self.versions)
         except Exception as e:
             return None
 
+    def bump(self, scope):
+        try:
+            self.storage.put(f"{self.versions_dir}/{scope}",
+                             uuid.uuid4().hex, self.versions)
+        except Exception as e:
+            pass
+
+    def render(self, scope, key, function, fallback=None):
+        """
+        The memoized result of function() for the current version of scope.
+        Nothing is memoized until the scope is bumped for the first time.
+        If function() raises, fallback is returned and isn't memoized
+        """
+        version = self.version(scope)
+        if version is not None:
+            cached = self.replies.lookup(f"{scope}/{key}")
+            if cached and cached[0] == version:
+                record_metric('reply_hit')
+                return cached[1]
+
+        try:
+            reply = function()
+        except Exception as e:
+            logging.error(f'{e=}')
+            return fallback
+        record_metric('reply_miss')
+        if version is not None:
+            self.replies.store(f"{scope}/{key}", version, reply)
+        return reply
+
 
 class RatingInfo:
-    def __init__(self, storage_client, bucket_name,
-                 ratings_dir, rivals_dir, active_top_days):
-        self.storage_client = storage_client
-        self.bucket_name = bucket_name
+    def __init__(self, storage, ratings_dir, rivals_dir,
+                 leaderboard_key, active_top_days, cache_size,
+                 rivals_index_dir=None, group=None, history=None):
+        self.storage = storage
+        self.history = history
+        self.group = group
+        self.player_index = storage.player_index
+        self.cache = ObjectCache(cache_size)
         self.ratings_dir = ratings_dir
         self.rivals_dir = rivals_dir
+        self.rivals_index_dir = rivals_index_dir
+        self.leaderboard_key = leaderboard_key
         self.active_top_days = active_top_days
 
+    def reset(self):
+        """
+        Forget everything kept in process, after the objects were replaced
+        """
+        self.cache.clear()
+
+    @staticmethod
+    def parse(r):
+        """
+        (rating, win, lose, *state) of a "rating,win,lose[,state...]" record,
+        the state is the rating model's per-player fields
+        """
+        values = r.split(',')
+        return (int(values[0]), int(values[1]), int(values[2]),
+                *(float(value) for value in values[3:]))
+
     def get(self, name):
         try:
-            r = self.storage_client.get_object(
-                Bucket=self.bucket_name,
-                Key=f"{self.ratings_dir}/{name}")['Body'].read().decode()
-            values = r.split(',')
-            return (int(values[0]), int(values[1]), int(values[2]))
+            return self.read(name)
         except Exception as e:
             return None
 
-    def set(self, name, rating, win, lose):
-        self.storage_client.put_object(
-            Bucket=self.bucket_name,
-            Key=f"{self.ratings_dir}/{name}",
-            Body=f'{rating},{win},{lose}')
+    def read(self, name):
+        """
+        Like get, but storage errors are raised
+        """
+        body = self.storage.get(f"{self.ratings_dir}/{name}", self.cache)
+        return self.parse(body) if body is not None else None
+
+    def set(self, name, rating, win, lose, *state):
+        record = ','.join([f'{rating},{win},{lose}', *(f'{value:.6g}' for value in state)])
+        self.storage.put(f"{self.ratings_dir}/{name}", record, self.cache)
 
     def delete(self, name):
         try:
-            self.storage_client.delete_object(
-                Bucket=self.bucket_name,
-                Key=f"{self.ratings_dir}/{name}")
+            self.storage.delete(f"{self.ratings_dir}/{name}", self.cache)
         except Exception as e:
             pass
 
-    def top(self):
+    def get_leaderboard(self):
+        """
+        Read the leaderboard snapshot: {name: [rating, win, lose, last_game]}
+        """
+        if self.player_index:
+            return self.storage.get_players(self.group)
+
         try:
-            response = self.storage_client.list_objects(
-                Bucket=self.bucket_name,
-                Prefix=self.ratings_dir)
+            return json.loads(
+                self.storage.get(self.leaderboard_key, self.cache))['players']
+        except Exception as e:
+            return None
 
-            if 'Contents' not in response:
-                return []
+    def read_leaderboard(self):
+        """
+        The leaderboard snapshot with its ETag, (None, None) if it's missing
+        """
+        body, etag = self.storage.get_versioned(self.leaderboard_key)
+        try:
+            return json.loads(body)['players'], etag
+        except Exception as e:
+            return None, None
+
+    def cached_leaderboard(self):
+        """
+        The leaderboard with its ETag as this container last read or wrote it,
+        None if it isn't cached. It may be stale, writes are conditional
+        """
+        if cached := self.cache.lookup(self.leaderboard_key):
+            etag, body = cached
+            return json.loads(body)['players'], etag
+        return None
+
+    def set_leaderboard(self, players, if_match=None, if_none_match=None):
+        if self.player_index:
+            self.storage.replace_players(players, self.group)
+            return
 
-            horizon = (datetime.datetime.now() -
-                       datetime.timedelta(self.active_top_days))
-            horizon_str = f'{horizon}'[:23]
+        self.storage.put(
+            self.leaderboard_key,
+            json.dumps({'players': players}, separators=(',', ':')),
+            self.cache, if_match=if_match, if_none_match=if_none_match)
+
+    def rebuild_leaderboard(self):
+        """
+        Regenerate the leaderboard snapshot from the per-player objects
+        """
+        players = self.scan_leaderboard()
+        self.set_leaderboard(players)
+        return players
+
+    def scan_leaderboard(self):
+        """
+        The leaderboard built from the per-player objects.
+        The last modification time of the object is used as the last game time
+        of those who've played, registrants without games get last_game=0
+        """
+        keys = [key for key in self.storage.list(self.ratings_dir)
+                if key['Key'] != f"{self.ratings_dir}/"]
+        bodies = self.storage.get_many(
+            [key['Key'] for key in keys], self.cache)
+
+        players = {}
+        for key, body in zip(keys, bodies):
+            try:
+                name = key['Key'].replace(f"{self.ratings_dir}/", '')
+                rating, win, lose = self.parse(body)[:3]
+                last_game = (int(key['LastModified'].timestamp())
+                             if win + lose else 0)
+                players[name] = [rating, win, lose, last_game]
+            except Exception as e:
+                pass
+        return players
+
+    def update_leaderboard(self, updates, leaderboard=None):
+        """
+        Apply {name: (rating, win, lose, last_game) or None} to the snapshot.
+        None removes the player, last_game=None keeps the previous value.
+        leaderboard is the (players, etag) passed by get_game_state, the
+        cached copy is used otherwise. The write is conditional and retried
+        on a fresh copy
+        """
+        if self.player_index:
+            self.storage.update_players(updates, self.group)
+            return
 
-            keys = [key['Key'].replace(f"{self.ratings_dir}/", '')
-                    for key in response['Contents']
-                    if (key['Key'] != f"{self.ratings_dir}/" and
-                        str(key['LastModified'])[:23] > horizon_str)
-                    ]
+        leaderboard = leaderboard or self.cached_leaderboard()
+        for _ in range(LEADERBOARD_UPDATE_RETRIES):
+            players, etag = leaderboard or self.read_leaderboard()
+            leaderboard = None
+            if players is None:
+                players = self.scan_leaderboard()
+
+            for name, values in updates.items():
+                if values is None:
+                    players.pop(name, None)
+                    continue
+
+                rating, win, lose, last_game = values
+                if last_game is None:
+                    last_game = players.get(name, [0, 0, 0, 0])[3]
+                players[name] = [int(rating), int(win), int(lose), last_game]
+
+            try:
+                if etag:
+                    self.set_leaderboard(players, if_match=etag)
+                else:
+                    self.set_leaderboard(players, if_none_match='*')
+                return
+            except PreconditionFailed:
+                continue
+
+        raise Exception("The leaderboard is being updated too often, try again")
+
+    def top(self, limit=None):
+        try:
+            horizon = time.time() - self.active_top_days * 24 * 60 * 60
+            if self.player_index:
+                return self.storage.top_players(horizon, limit, self.group)
 
-            if len(keys) == 0:
-                return []
+            players = self.get_leaderboard()
+            if players is None:
+                players = self.rebuild_leaderboard()
 
-            top = []
-            for k in keys:
-                r = self.get(k)
-                top.append((r, k))
+            top = [((rating, win, lose), name)
+                   for name, (rating, win, lose, last_game, *_) in players.items()
+                   if last_game > horizon]
 
             top.sort(reverse=True)
-            return top
+            return top[:limit]
 
         except Exception as e:
             return None
 
+    def get_game_state(self, name_1, name_2):
+        """
+        Read both players and their rivals stats at once. The leaderboard
+        comes from the cache, update_leaderboard reads it on a miss
+        """
+        return (*self.storage.gather(
+                    lambda: self.get(name_1),
+                    lambda: self.get(name_2),
+                    lambda: self.get_rivals_stats(name_1, name_2)),
+                None if self.player_index else self.cached_leaderboard())
+
+    def record_game(self, name_1, stats_1, name_2, stats_2,
+                    first_won, rivals_stats=None, players=None, score=None):
+        """
+        Write both players' (rating, win, lose), the rivals stats
+        and the leaderboard at once. players is the leaderboard
+        as read by get_game_state
+        """
+        win_1, win_2 = rivals_stats or (0, 0)
+        if first_won:
+            win_1 += 1
+        else:
+            win_2 += 1
+
+        now = int(time.time())
+        self.storage.gather(
+            lambda: self.set(name_1, *stats_1),
+            lambda: self.set(name_2, *stats_2),
+            lambda: self.set_rivals_stats(name_1, name_2, win_1, win_2),
+            lambda: self.update_leaderboard(
+                {name_1: (*stats_1[:3], now), name_2: (*stats_2[:3], now)}, players),
+            lambda: self.history.append(name_1, stats_1[0], name_2, now)
+            if self.history else None,
+            lambda: self.history.append(name_2, stats_2[0], name_1, now)
+            if self.history else None)
+
+    def history_of(self, name):
+        """
+        (timestamp, rating, opponent id) records of the player's recent changes
+        """
+        return self.history.recent(name)
+
     def get_rivals_stats(self, name_1, name_2):
+        if self.rivals_index_dir:
+            if values := self.get_all_rivals_stats(name_1).get(name_2):
+                return tuple(values)
+            return None
+
         try:
             turned = False
             if name_1 > name_2:
@@ -176,9 +1628,7 @@ class RatingInfo:
 
             joint_name = f"{name_1}+{name_2}"
 
-            r = self.storage_client.get_object(
-                Bucket=self.bucket_name,
-                Key=f"{self.rivals_dir}/{joint_name}")['Body'].read().decode()
+            r = self.storage.get(f"{self.rivals_dir}/{joint_name}", self.cache)
             values = r.split(',')
 
             if turned:
@@ -189,6 +1639,71 @@ class RatingInfo:
         except Exception as e:
             return None
 
+    def get_all_rivals_stats(self, name):
+        """
+        {opponent: (wins, loses)} of the player, None without the rivals
+        index: every pair-keyed object would have to be read
+        """
+        if not self.rivals_index_dir:
+            return None
+        try:
+            return {
+                opponent: tuple(values)
+                for opponent, values in json.loads(self.storage.get(
+                    f"{self.rivals_index_dir}/{name}", self.cache)).items()}
+        except Exception as e:
+            return {}
+
+    def get_pair_rivals_stats(self):
+        """
+        {(name_1, name_2): [win_1, win_2]} of all the pair-keyed objects
+        """
+        keys = [key['Key'] for key in self.storage.list(f"{self.rivals_dir}/")]
+        pairs = {}
+        for key, body in zip(keys, self.storage.get_many(keys, self.cache)):
+            try:
+                name_1, name_2 = key.replace(f"{self.rivals_dir}/", '').split('+')
+                pairs[(name_1, name_2)] = [int(x) for x in body.split(',')]
+            except Exception as e:
+                pass
+        return pairs
+
+    def get_rivals_table(self):
+        """
+        {"name_1+name_2": [win_1, win_2]} of every pair in either layout
+        """
+        if not self.rivals_index_dir:
+            return {f"{name_1}+{name_2}": wins for (name_1, name_2), wins
+                    in self.get_pair_rivals_stats().items()}
+
+        keys = [key['Key'] for key in self.storage.list(f"{self.rivals_index_dir}/")]
+        table = {}
+        for key, body in zip(keys, self.storage.get_many(keys, self.cache)):
+            try:
+                name = key.replace(f"{self.rivals_index_dir}/", '')
+                for opponent, (win, lose) in json.loads(body).items():
+                    if name < opponent:
+                        table[f"{name}+{opponent}"] = [win, lose]
+            except Exception as e:
+                pass
+        return table
+
+    def migrate_rivals(self):
+        """
+        Build the per-player rivals index from the pair-keyed objects
+        """
+        index = {}
+        for (name_1, name_2), (win_1, win_2) in self.get_pair_rivals_stats().items():
+            index.setdefault(name_1, {})[name_2] = [win_1, win_2]
+            index.setdefault(name_2, {})[name_1] = [win_2, win_1]
+
+        self.storage.put_many(
+            [(f"{self.rivals_index_dir}/{name}",
+              json.dumps(rivals, separators=(',', ':')))
+             for name, rivals in index.items()],
+            self.cache)
+        return index
+
     def increment_rivals_stats(self, name_1, name_2, first_won):
         ratings = self.get_rivals_stats(name_1, name_2) or (0, 0)
 
@@ -204,33 +1719,906 @@ class RatingInfo:
             name_1, name_2 = name_2, name_1
             win_1, win_2 = win_2, win_1
 
+        if self.rivals_index_dir:
+            self.storage.gather(
+                lambda: self.update_rivals_index(
+                    name_1, lambda rivals: rivals.update(
+                        {name_2: [int(win_1), int(win_2)]})),
+                lambda: self.update_rivals_index(
+                    name_2, lambda rivals: rivals.update(
+                        {name_1: [int(win_2), int(win_1)]})))
+            return
+
         joint_name = f"{name_1}+{name_2}"
 
-        self.storage_client.put_object(
-            Bucket=self.bucket_name,
-            Key=f"{self.rivals_dir}/{joint_name}", Body=f'{win_1},{win_2}')
+        self.storage.put(
+            f"{self.rivals_dir}/{joint_name}", f'{win_1},{win_2}', self.cache)
+
+
+    def update_rivals_index(self, name, change):
+        """
+        Apply change(rivals) to the player's index document, the write
+        is conditional on its ETag and retried on conflict: another game
+        of the same player may update it at the same time
+        """
+        key = f"{self.rivals_index_dir}/{name}"
+        for _ in range(CONDITIONAL_UPDATE_RETRIES):
+            body, etag = self.storage.get_versioned(key)
+            rivals = json.loads(body) if body else {}
+            change(rivals)
+            body = json.dumps(rivals, separators=(',', ':'))
+            try:
+                if etag:
+                    self.storage.put(key, body, self.cache, if_match=etag)
+                else:
+                    self.storage.put(key, body, self.cache, if_none_match='*')
+                return
+            except PreconditionFailed:
+                continue
+
+        raise Exception("The rivals stats are being updated too often, try again")
+
+
+class EventLogRatingInfo(RatingInfo):
+    """
+    Ratings derived from a compacted snapshot plus the immutable match events
+    written after it. Every modification is a single event PUT
+    """
+
+    def __init__(self, storage, ratings_dir, rivals_dir,
+                 leaderboard_key, active_top_days, cache_size,
+                 events_dir, snapshot_key, compact_every, history=None,
+                 settle_seconds=EVENTS_SETTLE_SECONDS):
+        super().__init__(storage, ratings_dir, rivals_dir,
+                         leaderboard_key, active_top_days, cache_size,
+                         history=history)
+        self.player_index = False
+        self.events_dir = events_dir
+        self.snapshot_key = snapshot_key
+        self.compact_every = compact_every
+        self.settle_seconds = settle_seconds
+        self.lock = threading.Lock()
+        self.snapshot_body = None
+        self.state = None
+        self.applied = {}
+        self.last_event = None
+        self.tail_size = 0
+        self.next_compaction = 0
+
+    def reset(self):
+        super().reset()
+        with self.lock:
+            self.snapshot_body = None
+            self.state = None
+
+    def initial_state(self):
+        """
+        The state built from the per-player and pair-keyed rivals objects
+        for a bucket that has no snapshot yet
+        """
+        players = (RatingInfo.get_leaderboard(self) or
+                   RatingInfo.rebuild_leaderboard(self))
+
+        keys = [key['Key'] for key in self.storage.list(self.rivals_dir)
+                if key['Key'] != f"{self.rivals_dir}/"]
+        rivals = {}
+        for key, body in zip(keys, self.storage.get_many(keys)):
+            try:
+                rivals[key.replace(f"{self.rivals_dir}/", '')] = [
+                    int(x) for x in body.split(',')]
+            except Exception as e:
+                pass
+
+        return {'players': players, 'rivals': rivals, 'last_event': ''}
+
+    def load_state(self):
+        """
+        Refresh the in-process state: revalidate the snapshot
+        and fold in the events written after it
+        """
+        with self.lock:
+            snapshot_body = self.storage.get(self.snapshot_key, self.cache)
+            if snapshot_body is None:
+                snapshot_body = json.dumps(
+                    self.initial_state(), separators=(',', ':'))
+                self.storage.put(self.snapshot_key, snapshot_body, self.cache)
+
+            if snapshot_body != self.snapshot_body:
+                self.snapshot_body = snapshot_body
+                self.state = json.loads(snapshot_body)
+                self.last_event = self.state.pop('last_event')
+                self.applied = {}
+
+            keys = [key['Key'] for key in self.storage.list(
+                        self.events_dir, start_after=self.last_event)]
+            new_keys = [key for key in keys if key not in self.applied]
+            for key, body in zip(new_keys, self.storage.get_many(new_keys)):
+                event = json.loads(body) if body is not None else None
+                if event:
+                    self.apply(event)
+                self.applied[key] = event
+
+            self.tail_size = len(keys)
+            return self.state
+
+    def apply(self, event, state=None):
+        if state is None:
+            state = self.state
+        players = state['players']
+        rivals = state['rivals']
+
+        if event['type'] == 'played':
+            (name_1, name_2), (delta_1, delta_2) = (
+                event['players'], event['deltas'])
+            first_won = event['score'][0] > event['score'][1]
+            for name, delta, won in ((name_1, delta_1, first_won),
+                                     (name_2, delta_2, not first_won)):
+                rating, win, lose, _, *model_state = players.get(
+                    name, [START_RATING, 0, 0, 0])
+                players[name] = [rating + delta, win + won, lose + (not won),
+                                 event['ts'], *model_state]
+            for name, model_state in zip(event['players'], event.get('states', [])):
+                players[name][4:] = model_state
+
+            if name_1 > name_2:
+                name_1, name_2 = name_2, name_1
+                first_won = not first_won
+            win_1, win_2 = rivals.get(f"{name_1}+{name_2}", [0, 0])
+            rivals[f"{name_1}+{name_2}"] = [
+                win_1 + first_won, win_2 + (not first_won)]
+
+        elif event['type'] == 'set':
+            name = event['name']
+            last_game = players.get(name, [0, 0, 0, 0])[3]
+            players[name] = [*event['stats'], last_game, *event.get('state', [])]
+
+        elif event['type'] == 'delete':
+            players.pop(event['name'], None)
+
+        elif event['type'] == 'set_rivals':
+            rivals[event['pair']] = event['wins']
+
+    def append(self, event):
+        event['ts'] = int(time.time())
+        key = f"{self.events_dir}/{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self.storage.put(key, json.dumps(event, separators=(',', ':')))
+
+        if self.state is not None:
+            with self.lock:
+                # A load_state of another thread may have applied it already
+                if key not in self.applied and key > self.last_event:
+                    self.apply(event)
+                    self.applied[key] = event
+                    self.tail_size += 1
+
+        if (self.tail_size >= self.compact_every and
+                time.time() >= self.next_compaction):
+            # The event is written already, a failed compaction is retried later
+            try:
+                self.compact()
+            except Exception as e:
+                logging.error(f'{e=}')
+
+    def compact(self):
+        """
+        Fold the events older than settle_seconds into a new snapshot.
+        Later reads list only the keys after the snapshot's last event,
+        so younger ones stay in the tail: an event of another container
+        with a lower key may still be on its way
+        """
+        self.load_state()
+        settled_ns = time.time_ns() - self.settle_seconds * 10 ** 9
+        cutoff = f"{self.events_dir}/{settled_ns:020d}"
+        with self.lock:
+            settled = sorted(key for key in self.applied if key < cutoff)
+            if not settled:
+                # Nothing to fold until the oldest event of the tail settles
+                oldest = min(self.applied, default=cutoff)
+                self.next_compaction = (int(oldest.rsplit('/', 1)[1][:20]) /
+                                        10 ** 9 + self.settle_seconds)
+                return
+
+            state = json.loads(self.snapshot_body)
+            state.pop('last_event')
+            records = self.fold(settled, state)
+            if self.history:
+                self.storage.gather(*(
+                    lambda name=name: self.history.extend(name, records[name])
+                    for name in records))
+
+            snapshot_body = json.dumps(
+                {**state, 'last_event': settled[-1]}, separators=(',', ':'))
+            self.storage.put(self.snapshot_key, snapshot_body, self.cache)
+            for key in settled:
+                self.applied.pop(key)
+            self.snapshot_body = snapshot_body
+            self.last_event = settled[-1]
+            self.tail_size = len(self.applied)
+
+    def fold(self, keys, state):
+        """
+        Apply the applied events of keys to state and return the history
+        records of their games: {name: [(timestamp, rating, opponent)]}
+        """
+        records = {}
+        for key in keys:
+            if event := self.applied[key]:
+                self.apply(event, state)
+                if event['type'] == 'played':
+                    name_1, name_2 = event['players']
+                    for name, opponent in ((name_1, name_2), (name_2, name_1)):
+                        records.setdefault(name, []).append(
+                            (event['ts'], state['players'][name][0], opponent))
+        return records
+
+    def history_of(self, name):
+        """
+        The records of the history chunks and of the games still in the tail
+        """
+        records, _ = self.storage.gather(
+            lambda: self.history.recent(name), self.load_state)
+        with self.lock:
+            tail = self.fold(sorted(self.applied), json.loads(self.snapshot_body))
+        return RatingHistory.ordered(records + [
+            (ts, rating, RatingHistory.opponent_id(opponent))
+            for ts, rating, opponent in tail.get(name, [])])
+
+    def get(self, name, players=None):
+        if players is None:
+            players = self.load_state()['players']
+        if values := players.get(name):
+            return (*values[:3], *values[4:])
+        return None
+
+    def read(self, name):
+        return self.get(name)
+
+    def set(self, name, rating, win, lose, *state):
+        event = {'type': 'set', 'name': name,
+                 'stats': [int(rating), int(win), int(lose)]}
+        if state:
+            event['state'] = [float(f'{value:.6g}') for value in state]
+        self.append(event)
+
+    def delete(self, name):
+        self.append({'type': 'delete', 'name': name})
+
+    def get_leaderboard(self):
+        return self.load_state()['players']
+
+    def set_leaderboard(self, players):
+        pass
+
+    def rebuild_leaderboard(self):
+        return self.load_state()['players']
+
+    def update_leaderboard(self, updates, players=None):
+        pass
+
+    def get_game_state(self, name_1, name_2):
+        players = self.load_state()['players']
+        return (self.get(name_1, players), self.get(name_2, players),
+                self.get_rivals_stats(name_1, name_2, self.state['rivals']),
+                players)
+
+    def record_game(self, name_1, stats_1, name_2, stats_2,
+                    first_won, rivals_stats=None, players=None, score=None):
+        if players is None:
+            players = self.load_state()['players']
+        event = {'type': 'played', 'players': [name_1, name_2],
+                 'score': score or [int(first_won), int(not first_won)],
+                 'deltas': [stats_1[0] - players[name_1][0],
+                            stats_2[0] - players[name_2][0]]}
+        if stats_1[3:] or stats_2[3:]:
+            event['states'] = [[float(f'{value:.6g}') for value in stats[3:]]
+                               for stats in (stats_1, stats_2)]
+        # The history is written from the event when it's compacted
+        self.append(event)
+
+    def get_rivals_stats(self, name_1, name_2, rivals=None):
+        turned = name_1 > name_2
+        if turned:
+            name_1, name_2 = name_2, name_1
+
+        if rivals is None:
+            rivals = self.load_state()['rivals']
+        if not (values := rivals.get(f"{name_1}+{name_2}")):
+            return None
+        return (values[1], values[0]) if turned else tuple(values)
+
+    def get_all_rivals_stats(self, name):
+        all_stats = {}
+        for pair, (win_1, win_2) in self.load_state()['rivals'].items():
+            name_1, name_2 = pair.split('+')
+            if name == name_1:
+                all_stats[name_2] = (win_1, win_2)
+            elif name == name_2:
+                all_stats[name_1] = (win_2, win_1)
+        return all_stats
+
+    def get_rivals_table(self):
+        return dict(self.load_state()['rivals'])
+
+    def set_rivals_stats(self, name_1, name_2, win_1, win_2):
+        if name_1 > name_2:
+            name_1, name_2 = name_2, name_1
+            win_1, win_2 = win_2, win_1
+
+        self.append({'type': 'set_rivals', 'pair': f"{name_1}+{name_2}",
+                     'wins': [int(win_1), int(win_2)]})
+
+
+class WebhookReplyBot(telebot.TeleBot):
+    """
+    TeleBot that can hold back the last reply of an update,
+    so it's returned in the webhook response instead of a Bot API call.
+    A held reply is sent first if another message follows it.
+    The messages of a batch are held until the batch is written
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reply_state = threading.local()
+
+    def defer_replies(self):
+        self.reply_state.deferring = True
+        self.reply_state.pending = None
+
+    def take_webhook_reply(self):
+        """
+        Stop deferring and return the held back reply as a sendMessage payload
+        """
+        pending = getattr(self.reply_state, 'pending', None)
+        self.reply_state.deferring = False
+        self.reply_state.pending = None
+        return pending
+
+    def flush_reply(self):
+        if pending := getattr(self.reply_state, 'pending', None):
+            self.reply_state.pending = None
+            self.send_message(
+                pending.pop('chat_id'), pending.pop('text'), **pending)
+
+    def hold_replies(self):
+        self.reply_state.held = []
+
+    def take_held_replies(self):
+        """
+        Stop holding messages and return the held ones as (args, kwargs)
+        """
+        held = getattr(self.reply_state, 'held', None) or []
+        self.reply_state.held = None
+        return held
+
+    def send_message(self, *args, **kwargs):
+        if (held := getattr(self.reply_state, 'held', None)) is not None:
+            held.append((args, kwargs))
+            return None
+        self.flush_reply()
+        kwargs.setdefault('timeout', call_timeout(BOT_API_TIMEOUT))
+        started = time.perf_counter()
+        try:
+            return super().send_message(*args, **kwargs)
+        finally:
+            record_metric('bot_api', time.perf_counter() - started)
+
+    def reply_to(self, message, text, **kwargs):
+        if not getattr(self.reply_state, 'deferring', False):
+            return super().reply_to(message, text, **kwargs)
+
+        self.flush_reply()
+        self.reply_state.pending = {
+            'chat_id': message.chat.id,
+            'text': text,
+            'reply_to_message_id': message.message_id,
+            **kwargs}
+
+
+class LazyBot:
+    """
+    Collects message handlers at import and builds the bot on first use.
+    Commands are dispatched through a table built at import, the bot
+    itself is only used to send messages
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.commands = {}
+        self.fallback = None
+        self.instance = None
+        self.lock = threading.Lock()
+
+    def message_handler(self, **kwargs):
+        def decorator(function):
+            for command in kwargs.get('commands', []):
+                self.commands[command] = instrument(function)
+            if 'regexp' in kwargs:
+                self.fallback = instrument(function)
+            return function
+        return decorator
+
+    def dispatch(self, update):
+        """
+        Run the handler of the raw update's leading command
+        """
+        command = command_of(update)
+        if command is None:
+            return
+        message = telebot.types.Message.de_json(update['message'])
+        self.commands.get(command, self.fallback)(message)
+
+    def get(self):
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    self.instance = self.factory()
+        return self.instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class StateArchive:
+    """
+    Compressed snapshot of a group's players, rivals, rating
+    history and queue objects, read and written in parallel chunks. Objects
+    are kept with their ETags, so the snapshot also seeds the caches of
+    a cold container
+    """
+
+    def __init__(self, storage, prefix, ratings, queue, archive_key, chunk_size,
+                 seasons=None):
+        self.storage = storage
+        self.prefix = prefix
+        self.ratings = ratings
+        self.queue = queue
+        self.seasons = seasons
+        self.archive_key = archive_key
+        self.chunk_size = chunk_size
+        self.warmed_up = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def compress(document):
+        return gzip.compress(json.dumps(document, separators=(',', ':')).encode())
+
+    @staticmethod
+    def decompress(data):
+        return json.loads(gzip.decompress(data))
+
+    def chunks(self, items):
+        for start in range(0, len(items), self.chunk_size):
+            yield items[start:start + self.chunk_size]
+
+    def object_keys(self):
+        dirs = [self.ratings.ratings_dir, self.ratings.rivals_dir,
+                self.ratings.rivals_index_dir,
+                getattr(self.ratings, 'events_dir', None),
+                self.ratings.history and self.ratings.history.history_dir,
+                self.seasons and self.seasons.seasons_dir,
+                self.seasons and self.seasons.cold_dir]
+        keys = [self.queue.queue_key, self.ratings.leaderboard_key,
+                getattr(self.ratings, 'snapshot_key', None),
+                self.seasons and self.seasons.season_key]
+
+        listings = self.storage.gather(*(
+            lambda directory=directory: self.storage.list(f"{directory}/")
+            for directory in dirs if directory))
+        return sorted({key['Key'] for listing in listings for key in listing} |
+                      {key for key in keys if key})
+
+    def dump(self):
+        """
+        The snapshot document: {'created', 'objects': {key: [etag, body]}},
+        keys are relative to the group's prefix
+        """
+        objects = {}
+        for chunk in self.chunks(self.object_keys()):
+            found = self.storage.gather(*(
+                lambda key=key: self.storage.get_versioned(key) for key in chunk))
+            objects.update(
+                (key.removeprefix(self.prefix), [etag, body])
+                for key, (body, etag) in zip(chunk, found) if body is not None)
+
+        document = {'created': int(time.time()), 'objects': objects}
+        if self.ratings.player_index:
+            document['players'] = self.ratings.get_leaderboard()
+        return document
+
+    def save(self, document):
+        self.storage.put(self.archive_key,
+                         base64.b64encode(self.compress(document)).decode())
+
+    def load(self):
+        body = self.storage.get(self.archive_key)
+        return self.decompress(base64.b64decode(body)) if body else None
+
+    def restore(self, document):
+        """
+        Replace the group's objects with the snapshot's ones
+        """
+        objects = {f"{self.prefix}{key}": body
+                   for key, (_, body) in document['objects'].items()}
+        stale = [key for key in self.object_keys() if key not in objects]
+
+        for chunk in self.chunks(list(objects.items())):
+            self.storage.put_many(chunk)
+        for chunk in self.chunks(stale):
+            self.storage.delete_many(chunk)
+        if document.get('players') is not None:
+            self.ratings.set_leaderboard(document['players'])
+
+        self.ratings.reset()
+        return len(objects)
+
+    def seed(self, document):
+        """
+        Fill the ratings cache with the snapshot's players, rivals,
+        leaderboard and queue; the events and the rating history would
+        only flood it. Snapshots older than the active window are skipped
+        """
+        if document['created'] < time.time() - self.ratings.active_top_days * 24 * 60 * 60:
+            return
+
+        dirs = tuple(f"{directory}/" for directory in (
+            self.ratings.ratings_dir, self.ratings.rivals_dir,
+            self.ratings.rivals_index_dir) if directory)
+        keys = {self.queue.queue_key, self.ratings.leaderboard_key}
+        objects = sorted(document['objects'].items(),
+                         key=lambda item: item[0] == LEADERBOARD_KEY)
+        for key, (etag, body) in objects:
+            key = f"{self.prefix}{key}"
+            if etag and (key in keys or key.startswith(dirs)):
+                self.ratings.cache.store(key, etag, body)
+
+    def warm_up(self):
+        """
+        Seed the caches from the stored snapshot once per container
+        """
+        if self.warmed_up:
+            return
+        with self.lock:
+            if self.warmed_up:
+                return
+            try:
+                if document := self.load():
+                    self.seed(document)
+            except Exception as e:
+                logging.error(f'{e=}')
+            self.warmed_up = True
+
+
+class SeasonArchive:
+    """
+    Closed seasons and the cold shards of long inactive players.
+    Closing a season stores its final standings and rivals stats in
+    a compressed archive and moves everyone who hasn't played for
+    cold_after_days out of the hot objects, so they only grow with
+    the active roster. Cold players are restored on their next game
+    """
+
+    def __init__(self, storage, ratings, season_key, seasons_dir, cold_dir,
+                 cold_shards, cold_after_days, update_retries):
+        self.storage = storage
+        self.ratings = ratings
+        self.season_key = season_key
+        self.seasons_dir = seasons_dir
+        self.cold_dir = cold_dir
+        self.cold_shards = cold_shards
+        self.cold_after_days = cold_after_days
+        self.update_retries = update_retries
+
+    def current(self):
+        """
+        {'season': number, 'started': timestamp or None}
+        """
+        try:
+            return json.loads(self.storage.get(self.season_key))
+        except Exception as e:
+            return {'season': 1, 'started': None}
+
+    def shard_key(self, name):
+        return f"{self.cold_dir}/{zlib.crc32(name.encode()) % self.cold_shards:03d}"
+
+    def read_shard(self, key):
+        """
+        ({name: {'stats', 'last_game', 'rivals'}}, etag) of a cold shard
+        """
+        body, etag = self.storage.get_versioned(key)
+        if not body:
+            return {}, None
+        return StateArchive.decompress(base64.b64decode(body)), etag
+
+    def update_shard(self, key, modify):
+        for _ in range(self.update_retries):
+            shard, etag = self.read_shard(key)
+            modify(shard)
+            body = base64.b64encode(StateArchive.compress(shard)).decode()
+            try:
+                if etag:
+                    self.storage.put(key, body, if_match=etag)
+                else:
+                    self.storage.put(key, body, if_none_match='*')
+                return
+            except PreconditionFailed:
+                continue
+        raise PreconditionFailed(key)
+
+    def close(self):
+        """
+        Archive the current season and move the inactive players
+        to the cold shards. Returns (season, standings, moved names)
+        """
+        season = self.current()
+        players = (self.ratings.get_leaderboard() or
+                   self.ratings.rebuild_leaderboard())
+        standings = sorted(
+            ([name, *values[:4]] for name, values in players.items()),
+            key=lambda row: row[1], reverse=True)
+        now = int(time.time())
+        document = {'season': season['season'], 'started': season['started'],
+                    'closed': now, 'standings': standings,
+                    'rivals': self.ratings.get_rivals_table()}
+        self.storage.put(f"{self.seasons_dir}/{season['season']:04d}",
+                         base64.b64encode(StateArchive.compress(document)).decode())
+
+        horizon = now - self.cold_after_days * 24 * 60 * 60
+        moved = self.move_to_cold(
+            {name: values[3] for name, values in players.items()
+             if values[3] < horizon})
+        self.storage.put(self.season_key, json.dumps(
+            {'season': season['season'] + 1, 'started': now}))
+        return season['season'], standings, moved
+
+    def move_to_cold(self, last_games):
+        """
+        Write the players of {name: last_game} into their cold shards,
+        then remove their hot objects and leaderboard entries
+        """
+        names = list(last_games)
+        stats = self.storage.gather(*(
+            lambda name=name: self.ratings.get(name) for name in names))
+        rivals = self.storage.gather(*(
+            lambda name=name: self.ratings.get_all_rivals_stats(name)
+            if self.ratings.rivals_index_dir else None for name in names))
+
+        shards = {}
+        for name, player_stats, player_rivals in zip(names, stats, rivals):
+            if player_stats is not None:
+                shards.setdefault(self.shard_key(name), {})[name] = {
+                    'stats': player_stats, 'last_game': last_games[name],
+                    'rivals': player_rivals}
+
+        self.storage.gather(*(
+            lambda key=key, moving=moving: self.update_shard(
+                key, lambda shard: shard.update(moving))
+            for key, moving in shards.items()))
+
+        moved = [name for moving in shards.values() for name in moving]
+        self.storage.gather(*(lambda name=name: self.remove_hot(name) for name in moved))
+        if moved:
+            self.ratings.update_leaderboard({name: None for name in moved})
+        return moved
+
+    def remove_hot(self, name):
+        self.ratings.delete(name)
+        if self.ratings.rivals_index_dir:
+            self.storage.delete(f"{self.ratings.rivals_index_dir}/{name}",
+                                self.ratings.cache)
+
+    def restore(self, name):
+        """
+        Move the player back from their cold shard and return
+        (rating, win, lose, *state), None if they aren't there
+        """
+        if not name:
+            return None
+        key = self.shard_key(name)
+        if not (record := self.read_shard(key)[0].get(name)):
+            return None
+
+        stats = tuple(record['stats'])
+        self.storage.gather(
+            lambda: self.ratings.set(name, *stats),
+            lambda: self.restore_rivals(name, record['rivals']),
+            lambda: self.ratings.update_leaderboard(
+                {name: (*stats[:3], record['last_game'])}))
+        self.update_shard(key, lambda shard: shard.pop(name, None))
+        return stats
+
+    def restore_rivals(self, name, rivals):
+        if not self.ratings.rivals_index_dir or rivals is None:
+            return
+        def restore(current):
+            # Pairs changed by the admin meanwhile are kept
+            for opponent, values in rivals.items():
+                current.setdefault(opponent, values)
+
+        self.ratings.update_rivals_index(name, restore)
 
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+class Tenant:
+    """
+    The queue, ratings, rating history, seasons and reply cache of one group.
+    Their objects are kept under the group's key prefix
+    """
+
+    def __init__(self, storage, prefix='', group=None):
+        self.prefix = prefix
+        self.group = group
+        self.queue = QueueInfo(storage, f"{prefix}{QUEUE_KEY}",
+                               f"{prefix}{QUEUE_DIR}", CONDITIONAL_UPDATE_RETRIES)
+        self.history = RatingHistory(storage, f"{prefix}{HISTORY_DIR}",
+                                     HISTORY_CHUNKS_READ, CONDITIONAL_UPDATE_RETRIES)
+        if RATINGS_STORAGE_MODE == 'events':
+            self.ratings = EventLogRatingInfo(
+                storage, f"{prefix}{PLAYERS_DIR}", f"{prefix}{RIVALS_DIR}",
+                f"{prefix}{LEADERBOARD_KEY}", ACTIVE_TOP_DAYS,
+                RATINGS_CACHE_SIZE, f"{prefix}{EVENTS_DIR}",
+                f"{prefix}{EVENTS_SNAPSHOT_KEY}", EVENTS_COMPACT_EVERY,
+                self.history)
+        else:
+            self.ratings = RatingInfo(
+                storage, f"{prefix}{PLAYERS_DIR}", f"{prefix}{RIVALS_DIR}",
+                f"{prefix}{LEADERBOARD_KEY}", ACTIVE_TOP_DAYS, RATINGS_CACHE_SIZE,
+                f"{prefix}{RIVALS_INDEX_DIR}" if RIVALS_STORAGE_MODE == 'index' else None,
+                group, self.history)
+        self.replies = ReplyCache(storage, f"{prefix}{VERSIONS_DIR}",
+                                  REPLY_CACHE_SIZE)
+        self.seasons = SeasonArchive(
+            storage, self.ratings, f"{prefix}{SEASON_KEY}", f"{prefix}{SEASONS_DIR}",
+            f"{prefix}{COLD_DIR}", COLD_SHARDS, COLD_AFTER_DAYS,
+            CONDITIONAL_UPDATE_RETRIES)
+        self.archive = StateArchive(storage, prefix, self.ratings, self.queue,
+                                    f"{prefix}{EXPORT_KEY}", EXPORT_CHUNK_SIZE,
+                                    self.seasons)
+
+    def bind(self, storage):
+        """
+        A copy of the tenant working on another storage, e.g. a unit of work
+        """
+        return Tenant(storage, self.prefix, self.group)
+
+
+class Tenants:
+    """
+    Tenants of the allowed groups, created on their first update.
+    Without GROUP_IDS every chat uses the default tenant, whose objects
+    are kept at the top of the bucket as before
+    """
+
+    def __init__(self, storage, groups_dir, group_ids):
+        self.storage = storage
+        self.groups_dir = groups_dir
+        self.group_ids = group_ids
+        self.default = Tenant(storage)
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.active = contextvars.ContextVar('tenant', default=None)
+
+    def get(self, group=None):
+        if group is None:
+            return self.default
+        with self.lock:
+            if group not in self.groups:
+                self.groups[group] = Tenant(
+                    self.storage, f"{self.groups_dir}/{group}/", group)
+            return self.groups[group]
+
+    def of(self, update):
+        """
+        The tenant of the update's chat or None for a group that isn't allowed.
+        Private chats and the GROUP_NAME group use the default tenant
+        """
+        chat = update['message']['chat']
+        if chat['id'] in self.group_ids:
+            return self.get(chat['id'])
+        if (self.group_ids and chat['type'] in ('group', 'supergroup') and
+                chat.get('title') != GROUP_NAME):
+            return None
+        return self.default
+
+    def current(self):
+        return self.active.get() or self.default
+
+
+class TenantComponent:
+    """
+    Module-level handle of a component of the current update's tenant
+    """
 
-boto_session = boto3.session.Session(
-    aws_access_key_id=S3_ACCESS_KEY_ID,
-    aws_secret_access_key=S3_SECRET_ACCESS_KEY
-)
+    def __init__(self, tenants, name):
+        self.tenants = tenants
+        self.name = name
 
-s3_storage_client = boto_session.client(
-    service_name='s3',
-    endpoint_url=S3_ENDPOINT_URL,
-    region_name=S3_REGION,
-)
+    def __getattr__(self, name):
+        return getattr(getattr(self.tenants.current(), self.name), name)
 
-queue = QueueInfo(s3_storage_client, S3_BUCKET_NAME, QUEUE_DIR)
-ratings = RatingInfo(s3_storage_client, S3_BUCKET_NAME,
-                     PLAYERS_DIR, RIVALS_DIR, ACTIVE_TOP_DAYS)
+
+def is_group_chat(chat):
+    return chat.title == GROUP_NAME or chat.id in GROUP_IDS
+
+
+def create_s3_client():
+    import boto3
+    import botocore.config
+
+    boto_session = boto3.session.Session(
+        aws_access_key_id=S3_ACCESS_KEY_ID,
+        aws_secret_access_key=S3_SECRET_ACCESS_KEY
+    )
+
+    return boto_session.client(
+        service_name='s3',
+        endpoint_url=S3_ENDPOINT_URL,
+        region_name=S3_REGION,
+        config=botocore.config.Config(
+            max_pool_connections=STORAGE_MAX_WORKERS,
+            connect_timeout=S3_CONNECT_TIMEOUT,
+            read_timeout=S3_READ_TIMEOUT,
+            retries={'mode': 'standard', 'total_max_attempts': S3_MAX_ATTEMPTS},
+            tcp_keepalive=True),
+    )
+
+
+def create_bot():
+    """
+    The bot with one keep-alive session shared by all threads,
+    its pool sized for the storage fan-out and the polling workers
+    """
+    import requests.adapters
+
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=BOT_API_POOL_SIZE))
+    telebot.apihelper.session = session
+    telebot.apihelper.SESSION_TIME_TO_LIVE = None
+    telebot.apihelper.CONNECT_TIMEOUT = BOT_API_TIMEOUT
+    telebot.apihelper.READ_TIMEOUT = BOT_API_TIMEOUT
+    return WebhookReplyBot(BOT_TOKEN, threaded=False)
+
+
+bot = LazyBot(create_bot)
+rating_model = RATING_MODELS[RATING_MODEL]()
+
+latency_histogram = LatencyHistogram(METRICS_HISTOGRAM_SIZE)
+if METRICS_LOG:
+    metrics_log.addHandler(logging.StreamHandler(sys.stdout))
+    metrics_log.setLevel(logging.INFO)
+    metrics_log.propagate = False
+
+if STORAGE_BACKEND == 'sqlite':
+    storage = SQLiteStorage(SQLITE_PATH)
+elif STORAGE_BACKEND == 'memory':
+    storage = MemoryStorage()
+else:
+    storage = S3Storage(create_s3_client, S3_BUCKET_NAME, STORAGE_MAX_WORKERS)
+deduplicator = UpdateDeduplicator(storage, UPDATES_KEY, RECENT_UPDATES_LOCAL,
+                                  RECENT_UPDATES_PERSISTED,
+                                  CONDITIONAL_UPDATE_RETRIES)
+tenants = Tenants(storage, GROUPS_DIR, GROUP_IDS)
+queue = TenantComponent(tenants, 'queue')
+ratings = TenantComponent(tenants, 'ratings')
+history = TenantComponent(tenants, 'history')
+replies = TenantComponent(tenants, 'replies')
+archive = TenantComponent(tenants, 'archive')
+seasons = TenantComponent(tenants, 'seasons')
 
 # ======================= RATING METHODS =======================
 
 
+def restore_player(player):
+    """
+    Bring the player back from the cold shards, None if they aren't there.
+    Users without a username have no player to restore
+    """
+    if not player:
+        return None
+    if stats := seasons.restore(player):
+        replies.bump('ratings')
+    return stats
+
+
 @bot.message_handler(commands=['register_me'])
 def register_handler(message):
     """
@@ -238,19 +2626,21 @@ def register_handler(message):
     """
     sender = message.from_user.username
 
-    if rating := ratings.get(sender):
+    if rating := ratings.get(sender) or restore_player(sender):
         bot.reply_to(
             message,
-            f"Seems you've already registered and your rating is {rating}.")
+            f"Seems you've already registered and your rating is {rating[0]} | {rating[1]} | {rating[2]} .")
         return
 
-    if message.chat.title != GROUP_NAME:
+    if not is_group_chat(message.chat):
         bot.reply_to(
             message,
             f'Sorry, the registration is allowed only at the group {GROUP_NAME}.')
         return
 
-    ratings.set(sender, START_RATING, 0, 0)
+    ratings.set(sender, START_RATING, 0, 0, *rating_model.initial())
+    ratings.update_leaderboard({sender: (START_RATING, 0, 0, None)})
+    replies.bump('ratings')
     bot.reply_to(message, f"Registered @{sender} with rating = {START_RATING}.")
 
 
@@ -261,6 +2651,8 @@ def delete_handler(message):
     """
     sender = message.from_user.username
     ratings.delete(sender)
+    ratings.update_leaderboard({sender: None})
+    replies.bump('ratings')
     bot.reply_to(
         message,
         f"Sorry to see you go, @{sender}. Your rating is deleted from the top.")
@@ -273,12 +2665,14 @@ def my_rating_handler(message):
     """
     sender = message.from_user.username
 
-    if rating := ratings.get(sender):
-        bot.reply_to(
-            message,
-            f"Your rating is {rating[0]} | {rating[1]} | {rating[2]} .")
-    else:
-        bot.reply_to(message, f"Seems @{sender} hasn't registered yet.")
+    def render():
+        if rating := ratings.read(sender) or restore_player(sender):
+            return f"Your rating is {rating[0]} | {rating[1]} | {rating[2]} ."
+        return f"Seems @{sender} hasn't registered yet."
+
+    bot.reply_to(message, replies.render(
+        'ratings', f"my_rating/{sender}", render,
+        f"Can't get your rating now, try again."))
 
 
 @bot.message_handler(commands=['rating_of'])
@@ -286,7 +2680,7 @@ def rating_of_handler(message):
     """
     Print rating of user
     """
-    if m := re.match(r"/rating_of @([a-zA-Z0-9_]+)", message.text):
+    if m := RATING_OF_PATTERN.match(message.text):
         player = m.group(1)
     else:
         bot.reply_to(
@@ -294,12 +2688,14 @@ def rating_of_handler(message):
             f'Something\'s wrong. You should use "/rating_of @someone".')
         return
 
-    if rating := ratings.get(player):
-        bot.reply_to(
-            message,
-            f"{player}'s rating is {rating[0]} | {rating[1]} | {rating[2]}.")
-    else:
-        bot.reply_to(message, f"Seems {player} hasn't registered yet.")
+    def render():
+        if rating := ratings.read(player):
+            return f"{player}'s rating is {rating[0]} | {rating[1]} | {rating[2]}."
+        return f"Seems {player} hasn't registered yet."
+
+    bot.reply_to(message, replies.render(
+        'ratings', f"rating_of/{player}", render,
+        f"Can't get {player}'s rating now, try again."))
 
 
 @bot.message_handler(commands=['stats_vs'])
@@ -309,7 +2705,7 @@ def stats_vs_handler(message):
     """
     sender = message.from_user.username
 
-    if m := re.match(r"/stats_vs @([a-zA-Z0-9_]+)", message.text):
+    if m := STATS_VS_PATTERN.match(message.text):
         player = m.group(1)
     else:
         bot.reply_to(
@@ -330,15 +2726,41 @@ def stats_vs_handler(message):
             message,
             f"Seems {sender} and {player} haven't played against each other yet.")
 
+
+@bot.message_handler(commands=['stats_vs_all'])
+def stats_vs_all_handler(message):
+    """
+    Print personal stats of user against everyone they played with
+    """
+    sender = message.from_user.username
+    all_stats = ratings.get_all_rivals_stats(sender)
+
+    if all_stats is None:
+        bot.reply_to(
+            message,
+            f'Stats against everyone are kept only with RIVALS_STORAGE_MODE=index.')
+    elif all_stats:
+        stats_repr = "\n".join(
+            f"{sender} - {stats[0]} | {stats[1]} - {player}"
+            for player, stats in sorted(
+                all_stats.items(), key=lambda item: -sum(item[1])))
+        bot.reply_to(message, f"Your stats against everyone:\n{stats_repr}")
+    else:
+        bot.reply_to(message, f"Seems {sender} hasn't played with anyone yet.")
+
+
 @bot.message_handler(commands=['top'])
 def top_handler(message):
     """
-    Print the current top ratings.
-    It's better to remove this method if you want to use bot in large group or just cache results
+    Print the current top ratings from the leaderboard snapshot
     """
-    top = ratings.top()
+    def render():
+        top = ratings.top()
+        if top is None:
+            raise Exception("Can't read the top")
+        if not top:
+            return None
 
-    if top:
         top_size = len(top)
 
         if 0 < top_size:
@@ -348,19 +2770,95 @@ def top_handler(message):
         if 2 < top_size:
             top[2] = (top[2][0], top[2][1] + ' 🥉')
 
-        top_repr = "\n".join(
+        return "\n".join(
             [f"{handler} = {rates[0]} | {rates[1]} | {rates[2]}"
                 for (rates, handler) in top])
 
-        prefix_str = np.random.choice(
+    # The active players change with the day as well
+    day = datetime.datetime.now(datetime.timezone.utc).date()
+    top_repr = replies.render('ratings', f"top/{day}", render)
+
+    if top_repr:
+        prefix_str = random.choices(
             ['Active Top\nPlayer = Pts | W | L',
                 'People who might work instead of this'],
-            p=[0.9, 0.1])
+            weights=[0.9, 0.1])[0]
 
         bot.reply_to(message, f"{prefix_str}:\n{top_repr}")
     else:
         bot.reply_to(message, f"Can't get anything")
 
+
+
+@bot.message_handler(commands=['predict'])
+def predict_handler(message):
+    """
+    Print the expected outcome of a game between two players
+    """
+    if m := PREDICT_PATTERN.match(message.text):
+        player_1, player_2 = m.group(1), m.group(2)
+    else:
+        bot.reply_to(
+            message,
+            f'Something\'s wrong. You should use "/predict @someone1 @someone2".')
+        return
+
+    if player_1 == player_2:
+        bot.reply_to(
+            message,
+            f"Not sure that {player_1} could play with themself")
+        return
+
+    rating_1, rating_2 = ratings.storage.gather(
+        lambda: ratings.get(player_1), lambda: ratings.get(player_2))
+    for player, rating in ((player_1, rating_1), (player_2, rating_2)):
+        if not rating:
+            bot.reply_to(message, f"Seems {player} hasn't registered yet.")
+            return
+
+    chance = expected_score(rating_1[0], rating_2[0])
+    bot.reply_to(
+        message,
+        f"{player_1} ({rating_1[0]}) - {chance:.0%} | "
+        f"{1 - chance:.0%} - {player_2} ({rating_2[0]})")
+
+
+@bot.message_handler(commands=['history'])
+def history_handler(message):
+    """
+    Print the recent rating trend, peak and percentiles of a player
+    """
+    if m := HISTORY_PATTERN.match(message.text):
+        player = m.group(1)
+    else:
+        bot.reply_to(
+            message,
+            f'Something\'s wrong. You should use "/history @someone".')
+        return
+
+    def render():
+        records = ratings.history_of(player)
+        if not records:
+            return f"No rating changes of {player} yet."
+
+        ratings_seen = [rating for _, rating, _ in records]
+        trend = ratings_seen[-HISTORY_TREND_GAMES:]
+        peak_ts, peak, _ = max(records, key=lambda record: record[1])
+        peak_day = datetime.datetime.fromtimestamp(peak_ts, datetime.timezone.utc)
+        since = datetime.datetime.fromtimestamp(records[0][0], datetime.timezone.utc)
+        return (
+            f"{player}'s last {len(trend)} changes: "
+            f"{' > '.join(map(str, trend))} ({trend[-1] - trend[0]:+d})\n"
+            f"Peak since {since:%Y-%m-%d}: {peak} on {peak_day:%Y-%m-%d}\n"
+            f"Percentiles of {len(records)} changes: "
+            f"p10 {RatingHistory.percentile(ratings_seen, 0.1)}, "
+            f"p50 {RatingHistory.percentile(ratings_seen, 0.5)}, "
+            f"p90 {RatingHistory.percentile(ratings_seen, 0.9)}")
+
+    bot.reply_to(message, replies.render(
+        'ratings', f"history/{player}", render,
+        f"Can't get {player}'s history now, try again."))
+
 # ======================= QUEUE METHODS =======================
 
 
@@ -369,16 +2867,47 @@ def queue_handler(message):
     """
     Printing queue's members
     """
-    current_queue = queue.waiting_list()
+    def render():
+        current_queue = queue.waiting_list()
+        if current_queue is None:
+            raise Exception("Can't read the queue")
 
-    if current_queue:
-        table_owner = current_queue[0]
-        queue_repr = "\n".join(f"{x}" for x in current_queue[1:])
-        waiting_list = f"The waiting list:\n{queue_repr}" if queue_repr else "The waiting list is empty."
+        if current_queue:
+            table_owner = current_queue[0]
+            queue_repr = "\n".join(f"{x}" for x in current_queue[1:])
+            waiting_list = f"The waiting list:\n{queue_repr}" if queue_repr else "The waiting list is empty."
 
-        bot.reply_to(message, f"Expected that {table_owner} is playing now.\n{waiting_list}")
-    else:
-        bot.reply_to(message, f"The queue is empty.")
+            return f"Expected that {table_owner} is playing now.\n{waiting_list}"
+        return f"The queue is empty."
+
+    bot.reply_to(message, replies.render(
+        'queue', 'queue', render, f"Can't get the queue now, try again."))
+
+
+@bot.message_handler(commands=['suggest'])
+def suggest_handler(message):
+    """
+    Suggest the most balanced games between the queue's members
+    """
+    current_queue, players = ratings.storage.gather(
+        queue.waiting_list, ratings.get_leaderboard)
+
+    if not current_queue or len(current_queue) < 2:
+        bot.reply_to(message, f"Need at least two players in the queue.")
+        return
+
+    players = players or {}
+    pairs = balanced_pairs(
+        [players.get(name, [START_RATING])[0] for name in current_queue])
+
+    pairs_repr = "\n".join(
+        f"{current_queue[i]} - {chance:.0%} | {1 - chance:.0%} - {current_queue[j]}"
+        for i, j, chance in pairs)
+    paired = {player for i, j, _ in pairs for player in (i, j)}
+    waiting = [name for i, name in enumerate(current_queue) if i not in paired]
+    waiting_repr = f"\n{waiting[0]} waits for the next round." if waiting else ""
+
+    bot.reply_to(message, f"The most balanced games:\n{pairs_repr}{waiting_repr}")
 
 
 @bot.message_handler(commands=['book'])
@@ -387,19 +2916,18 @@ def book_handler(message):
     Adding a user into the queue
     """
     sender = message.from_user.username
-    current_queue = queue.waiting_list()
+    current_queue, booked = queue.book_table(
+        sender, message.message_id, message.chat.id)
+    if booked:
+        replies.bump('queue')
 
-    if current_queue and sender in current_queue:
+    if not booked:
         if sender == current_queue[0]:
             bot.reply_to(message, f"But you should be playing right now, huh?")
         else:
             bot.reply_to(message, f"But you're alredy in the queue.")
         return
 
-    queue.book_table(sender, message.message_id, message.chat.id)
-
-    current_queue.append(sender)
-
     if sender == current_queue[0]:
         bot.reply_to(
             message,
@@ -418,26 +2946,25 @@ def leave_handler(message):
     Leaving the queue and notifying the next user
     """
     sender = message.from_user.username
-    current_queue = queue.waiting_list()
+    current_queue, next_booking = queue.leave_table(sender)
+    if sender in (current_queue or []):
+        replies.bump('queue')
 
     if current_queue:
         if sender not in current_queue:
             bot.reply_to(message, f"But you aren't in the queue now.")
             return
 
-        position = current_queue.index(sender)
-        queue.leave_table(sender)
         bot.reply_to(message, f"Thanks for letting us know, @{sender}.")
 
-        if len(current_queue) > 1 and position == 0:
-            handler_to_notify = current_queue[1]
-            ids = queue.get_booking_info(handler_to_notify)
-            if ids:
-                mid, cid = ids
-                bot.send_message(
-                    cid,
-                    f"You're the next in the queue, @{handler_to_notify}.",
-                    reply_to_message_id=mid)
+        if next_booking and not budget_allows(OPTIONAL_WORK_MIN_MS / 1000):
+            record_metric('skipped_notification')
+        elif next_booking:
+            handler_to_notify, mid, cid = next_booking
+            bot.send_message(
+                cid,
+                f"You're the next in the queue, @{handler_to_notify}.",
+                reply_to_message_id=mid)
     else:
         bot.reply_to(message, f"But the queue is empty...")
 
@@ -447,14 +2974,13 @@ def clean_queue_handler(message):
     """
     Cleaning queue
     """
-    current_queue = queue.waiting_list()
+    current_queue = queue.clean()
     if current_queue:
+        replies.bump('queue')
         waiting_list = ", ".join(f"@{handler}" for handler in current_queue)
         bot.reply_to(
             message,
-            f"Ok, going to clean up the queue with all these guys: {waiting_list}.")
-        for handler in current_queue:
-            queue.leave_table(handler)
+            f"Ok, cleaned up the queue with all these guys: {waiting_list}.")
     else:
         bot.reply_to(message, f"But the queue is empty")
 
@@ -467,13 +2993,13 @@ def played_handler(message):
     Sending a game results
     """
     player_1 = message.from_user.username
-    if message.chat.title != GROUP_NAME and player_1 != ADMIN_HANDLER:
+    if not is_group_chat(message.chat) and player_1 != ADMIN_HANDLER:
         bot.reply_to(
             message,
             f'Sorry, rating games should be posted only into the group.')
         return
 
-    if m := re.match(r"/played @([a-zA-Z0-9_]+) (\d+)-(\d+)", message.text):
+    if m := PLAYED_PATTERN.match(message.text):
         player_2 = m.group(1)
         a = int(m.group(2))
         b = int(m.group(3))
@@ -493,50 +3019,55 @@ def played_handler(message):
         bot.reply_to(message, f"You think I'm funny, yeah?.")
         return
 
-    if not (ratings_1 := ratings.get(player_1)):
+    ratings_1, ratings_2, rivals_stats, players = ratings.get_game_state(
+        player_1, player_2)
+    if not ratings_1 or not ratings_2:
+        # Long inactive players are kept in the cold shards
+        ratings_1 = ratings_1 or restore_player(player_1)
+        ratings_2 = ratings_2 or restore_player(player_2)
+        rivals_stats, players = ratings.get_rivals_stats(player_1, player_2), None
+
+    if not ratings_1:
         bot.reply_to(
             message,
             f"Seems there is no rating for @{player_1}, need to register at first.")
         return
 
-    if not (ratings_2 := ratings.get(player_2)):
+    if not ratings_2:
         bot.reply_to(
             message,
             f"Seems there is no rating for @{player_2}, need to register at first.")
         return
 
-    rating_1, wins_1, loses_1 = ratings_1
-    rating_2, wins_2, loses_2 = ratings_2
+    rating_1, wins_1, loses_1, *state_1 = ratings_1
+    rating_2, wins_2, loses_2, *state_2 = ratings_2
 
-    game_score_adjustment = 0.1 + abs(a - b) * 0.2
     if a > b:
-        adjustment_1 = 0.5 + game_score_adjustment
-        adjustment_2 = 0.5 - game_score_adjustment
         wins_1 += 1
         loses_2 += 1
     else:
-        adjustment_1 = 0.5 - game_score_adjustment
-        adjustment_2 = 0.5 + game_score_adjustment
         wins_2 += 1
         loses_1 += 1
 
-    def E(rating_a, rating_b):
-        return 1.0 / (1 + ELO_BASE ** ((rating_b - rating_a) / ELO_POWER_DENOMINATOR))
-
-    new_rating_1 = int(rating_1 + ELO_MULTIPLIER * (adjustment_1 - E(rating_1, rating_2)))
-    new_rating_2 = int(rating_2 + ELO_MULTIPLIER * (adjustment_2 - E(rating_2, rating_1)))
+    (new_rating_1, *new_state_1), (new_rating_2, *new_state_2) = rating_model.rate(
+        (rating_1, *state_1), (rating_2, *state_2), a, b)
 
-    ratings.set(player_1, new_rating_1, wins_1, loses_1)
-    ratings.set(player_2, new_rating_2, wins_2, loses_2)
-    ratings.increment_rivals_stats(player_1, player_2, a > b)
+    message_from_bot = random.choices(['Cheers!', 'Nice game!', 'I\'ve seen better...', 'I\'m quite dissapointed of that.'], weights=[0.75, 0.2, 0.04, 0.01])[0]
 
-    message_from_bot = np.random.choice(['Cheers!', 'Nice game!', 'I\'ve seen better...', 'I\'m quite dissapointed of that.'], p=[0.75, 0.2, 0.04, 0.01])
+    # Rejected up front if the budget is short, rather than aborted
+    # after some of the objects are written
+    with write_phase(WRITE_PHASE_MIN_MS / 1000):
+        ratings.record_game(
+            player_1, (new_rating_1, wins_1, loses_1, *new_state_1),
+            player_2, (new_rating_2, wins_2, loses_2, *new_state_2),
+            a > b, rivals_stats, players, (a, b))
+        replies.bump('ratings')
 
-    bot.reply_to(message, f"Rating updates from @{player_1} {a}-{b} @{player_2}:\n"
-        f"@{player_1} {rating_1} -> {new_rating_1}\n"
-        f"@{player_2} {rating_2} -> {new_rating_2}\n"
-        f"{message_from_bot}\n"
-        f"#games #{player_1}_games #{player_2}_games")
+        bot.reply_to(message, f"Rating updates from @{player_1} {a}-{b} @{player_2}:\n"
+            f"@{player_1} {rating_1} -> {new_rating_1}\n"
+            f"@{player_2} {rating_2} -> {new_rating_2}\n"
+            f"{message_from_bot}\n"
+            f"#games #{player_1}_games #{player_2}_games")
 
 
 @bot.message_handler(commands=['set_score'])
@@ -550,7 +3081,7 @@ def set_score_handler(message):
         bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
         return
 
-    if m := re.match(r"/set_score @([a-zA-Z0-9_]+) (\d+) (\d+) (\d+)", message.text):
+    if m := SET_SCORE_PATTERN.match(message.text):
         player = m.group(1)
         player_score = m.group(2)
         player_win = m.group(3)
@@ -565,7 +3096,14 @@ def set_score_handler(message):
         bot.reply_to(message, f'Score should be higher than {ELO_MULTIPLIER}.')
         return
 
-    ratings.set(player, player_score, player_win, player_lose)
+    # Keep the rating model's state (e.g. glicko deviation and volatility)
+    state = (ratings.get(player) or ())[3:]
+    ratings.storage.gather(
+        lambda: ratings.set(player, player_score, player_win, player_lose, *state),
+        lambda: history.append(player, player_score))
+    ratings.update_leaderboard(
+        {player: (player_score, player_win, player_lose, None)})
+    replies.bump('ratings')
     bot.reply_to(message, f"@{player}'s rating = {player_score} | {player_win} | {player_lose} now.")
 
 
@@ -580,7 +3118,7 @@ def set_stats_vs_handler(message):
         bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
         return
 
-    if m := re.match(r"/set_stats_vs @([a-zA-Z0-9_]+) @([a-zA-Z0-9_]+) (\d+) (\d+)", message.text):
+    if m := SET_STATS_VS_PATTERN.match(message.text):
         player_1 = m.group(1)
         player_2 = m.group(2)
         player_1_win = m.group(3)
@@ -600,6 +3138,140 @@ def set_stats_vs_handler(message):
         message,
         f"So, now we have {player_1} - {player_1_win} | {player_2_win} - {player_2}")
 
+
+@bot.message_handler(commands=['rebuild_top'])
+def rebuild_top_handler(message):
+    """
+    Regenerating the leaderboard snapshot from players' ratings for admin
+    """
+    sender = message.from_user.username
+
+    if sender != ADMIN_HANDLER:
+        bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
+        return
+
+    players = ratings.rebuild_leaderboard()
+    replies.bump('ratings')
+    bot.reply_to(message, f"The top is rebuilt from {len(players)} ratings.")
+
+
+@bot.message_handler(commands=['migrate_rivals'])
+def migrate_rivals_handler(message):
+    """
+    Building the per-player rivals index from the pair-keyed stats for admin
+    """
+    sender = message.from_user.username
+
+    if sender != ADMIN_HANDLER:
+        bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
+        return
+
+    if not ratings.rivals_index_dir:
+        bot.reply_to(
+            message,
+            f'The rivals index is used only with RIVALS_STORAGE_MODE=index.')
+        return
+
+    index = ratings.migrate_rivals()
+    bot.reply_to(message, f"The rivals index is built for {len(index)} players.")
+
+
+@bot.message_handler(commands=['replay_ratings'])
+def replay_ratings_handler(message):
+    """
+    Recomputing all ratings from the match history for admin
+    """
+    sender = message.from_user.username
+
+    if sender != ADMIN_HANDLER:
+        bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
+        return
+
+    if RATINGS_STORAGE_MODE != 'events':
+        bot.reply_to(
+            message,
+            f'The match history is kept only with RATINGS_STORAGE_MODE=events.')
+        return
+
+    import elo_replay
+
+    events = elo_replay.load_events(storage, ratings.events_dir)
+    matches = elo_replay.read_matches(events)
+    initial = elo_replay.initial_players(ratings)
+    resets = elo_replay.read_resets(events)
+    if RATING_MODEL == 'elo':
+        result = elo_replay.replay(matches, initial=initial, resets=resets)
+    else:
+        result = elo_replay.replay_periods(
+            elo_replay.read_periods(events, 0), rating_model, rate_idle=False,
+            initial=initial, resets=resets)
+    updates = elo_replay.write_back(ratings, result)
+    replies.bump('ratings')
+    bot.reply_to(
+        message,
+        f"Replayed {len(matches)} games, {len(updates)} ratings are recomputed.")
+
+
+
+@bot.message_handler(commands=['export_state'])
+def export_state_handler(message):
+    """
+    Saving every player, rivals and queue object into one compressed snapshot
+    """
+    sender = message.from_user.username
+    if sender != ADMIN_HANDLER:
+        bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
+        return
+
+    document = archive.dump()
+    archive.save(document)
+    bot.reply_to(
+        message,
+        f"Exported {len(document['objects'])} objects into {archive.archive_key}.")
+
+
+@bot.message_handler(commands=['import_state'])
+def import_state_handler(message):
+    """
+    Replacing the state with the last exported snapshot
+    """
+    sender = message.from_user.username
+    if sender != ADMIN_HANDLER:
+        bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
+        return
+
+    if not (document := archive.load()):
+        bot.reply_to(message, f"There's no exported snapshot to import.")
+        return
+
+    imported = archive.restore(document)
+    replies.bump('ratings')
+    replies.bump('queue')
+    created = datetime.datetime.fromtimestamp(
+        document['created'], datetime.timezone.utc)
+    bot.reply_to(
+        message,
+        f"Imported {imported} objects exported at {created:%Y-%m-%d %H:%M} UTC.")
+
+
+@bot.message_handler(commands=['close_season'])
+def close_season_handler(message):
+    """
+    Archiving the season's standings and moving inactive players to the cold shards
+    """
+    sender = message.from_user.username
+    if sender != ADMIN_HANDLER:
+        bot.reply_to(message, f'Allowed only for {ADMIN_HANDLER}')
+        return
+
+    season, standings, moved = seasons.close()
+    replies.bump('ratings')
+    bot.reply_to(
+        message,
+        f"Season {season} is closed with {len(standings)} players in the standings.\n"
+        f"Moved {len(moved)} players inactive for {COLD_AFTER_DAYS} days "
+        f"to the archive, they're back with their next game.")
+
 # ======================= HELP METHOD =======================
 
 
@@ -624,10 +3296,14 @@ These commands will help you to save the results and book the table\*:
 `/my_rating` - Post your rating
 `/rating_of @someone` - Post someone's rating
 `/stats_vs @someone` - Your personal stats against @someone
+`/stats_vs_all` - Your personal stats against everyone you played with
 `/top` - List of top scorers
+`/predict @someone1 @someone2` - Chances of @someone1 and @someone2 to win against each other
+`/history @someone` - Recent rating trend, peak and percentiles of @someone
 
 **Queue**:
 `/queue` - Get the waiting list state
+`/suggest` - Suggest the most balanced games between everyone in the queue
 `/book` - Add me into the waiting list
 `/leave` - Leave the table (when you finish playing) or leave the queue
 `/clean_queue` - Clean the waiting list if some confusion happened
@@ -635,6 +3311,12 @@ These commands will help you to save the results and book the table\*:
 **Admin**(Only allowed for administrator of this bot):
 `/set_score @someone 1 2 3` - Set top stats for @someone with rating=1, wins=2 and loses=3
 `/set_stats_vs @someone1 @someone2 1 2` - Set rivals stats between @someone1 and @someone2 as 1-2
+`/rebuild_top` - Regenerate the top from the players' ratings if it seems stale
+`/replay_ratings` - Recompute all ratings from the match history
+`/migrate_rivals` - Build the rivals index from the old per-pair stats
+`/export_state` - Save all ratings, rivals and the queue into one compressed snapshot
+`/import_state` - Restore everything from the last exported snapshot
+`/close_season` - Archive the season's standings and move long inactive players out of the top
 
 If something went wrong, please ask admin of your group ({ADMIN_HANDLER}) to fix ratings
 \*We're using modifed ELO rating where the actual game score slightly amplifies the total rating change""",
@@ -650,13 +3332,120 @@ def default_handler(message):
     bot.reply_to(message, "Not sure, what you meant by that")
 
 
+@contextlib.contextmanager
+def unit_of_work(batch_tenants):
+    """
+    Run a batch of updates against one UnitOfWork and flush it if none
+    of them failed. Yields the batch's own copies of the tenants, bound
+    to the unit of work, so other threads keep using the storage
+    """
+    work = UnitOfWork(storage)
+    yield {tenant: tenant.bind(work) for tenant in batch_tenants}
+    work.flush()
+
+
+def run_batch(updates):
+    """
+    Run the updates in one unit of work. Their replies are held until
+    the batch is written, a batch conflicting with another writer is
+    re-run on fresh reads
+    """
+    for _ in range(CONDITIONAL_UPDATE_RETRIES):
+        bot.hold_replies()
+        try:
+            with unit_of_work({tenant for _, tenant in updates}) as bound:
+                for update, tenant in updates:
+                    dispatch(update, tenant, bound[tenant])
+        except PreconditionFailed:
+            continue
+        finally:
+            held = bot.take_held_replies()
+
+        for args, kwargs in held:
+            bot.send_message(*args, **kwargs)
+        return
+
+    raise Exception("The batch is being updated too often, try again")
+
+
+def updates_of(event):
+    """
+    Raw command updates of the event: a webhook body with one update or
+    a list of them, or a message queue trigger with an update per message.
+    Bodies without a command entity are dropped before parsing
+    """
+    if 'messages' in event:
+        bodies = [message['details']['message']['body']
+                  for message in event['messages']]
+    else:
+        bodies = [event["body"]]
+
+    updates = []
+    for body in bodies:
+        if '"bot_command"' not in body:
+            continue
+        parsed = json.loads(body)
+        updates.extend(parsed if isinstance(parsed, list) else [parsed])
+    return [update for update in updates if command_of(update)]
+
+
+def dispatch(update, tenant, bound=None):
+    """
+    Run the update's handler for the tenant, or for its copy bound
+    to a unit of work
+    """
+    if WARM_UP_FROM_EXPORT and command_of(update) not in STATELESS_COMMANDS:
+        tenant.archive.warm_up()
+
+    token = tenants.active.set(bound or tenant)
+    try:
+        bot.dispatch(update)
+    finally:
+        tenants.active.reset(token)
+
+
 def handler(event, context):
+    metrics = InvocationMetrics()
+    token = current_metrics.set(metrics)
+    deadline_token = current_deadline.set(Deadline.of(context, DEADLINE_MARGIN_MS))
+    updates = []
     try:
         logging.info(f'{event=}')
 
-        request_body_dict = json.loads(event["body"])
-        update = telebot.types.Update.de_json(request_body_dict)
-        bot.process_new_updates([update])
+        updates = deduplicator.new_updates(
+            [(update, tenant) for update in updates_of(event)
+             if (tenant := tenants.of(update))])
+        if not updates:
+            metrics.command = 'skipped'
+            return {
+                'statusCode': 200,
+                'headers': {},
+                'isBase64Encoded': False
+            }
+
+        if len(updates) > 1:
+            run_batch(updates)
+            metrics.command = 'batch'
+            return {
+                'statusCode': 200,
+                'headers': {},
+                'isBase64Encoded': False
+            }
+
+        if WEBHOOK_REPLY_MODE:
+            bot.defer_replies()
+        try:
+            dispatch(*updates[0])
+        finally:
+            reply = bot.take_webhook_reply()
+
+        if reply:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'method': 'sendMessage', **reply}),
+                'isBase64Encoded': False
+            }
         return {
             'statusCode': 200,
             'headers': {},
@@ -664,3 +3453,10 @@ def handler(event, context):
         }
     except Exception as e:
         logging.error(f'{e=}')
+        metrics.error = repr(e)
+        # Let Telegram's retry run the failed updates again
+        deduplicator.forget(updates)
+    finally:
+        current_deadline.reset(deadline_token)
+        current_metrics.reset(token)
+        emit_metrics(metrics)
@@ -0,0 +1,175 @@
+# Long-polling runner for self-hosted deployments
+# Updates are fetched with getUpdates and dispatched to a bounded pool of
+# workers. Within a batch the updates are split into lanes by the players
+# and shared objects they write: a lane runs its updates in order on one
+# worker, independent lanes run in parallel. The offset is stored next to
+# the bot's objects once a batch is done, so a restart neither loses nor
+# repeats updates. SIGINT/SIGTERM finish the current batch and exit.
+#
+# Usage: python polling.py
+# Uses the same environment as the webhook handler plus POLLING_WORKERS
+# and POLLING_TIMEOUT. The bot's webhook has to be removed beforehand,
+# Telegram refuses getUpdates while it is set.
+
+import json
+import logging
+import os
+import re
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+
+import index
+
+POLLING_WORKERS = int(os.getenv("POLLING_WORKERS", 4))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 25))
+POLLING_RETRY_DELAY = 5
+POLLING_OFFSET_KEY = 'polling_offset'
+QUEUE_COMMANDS = {'book', 'leave', 'clean_queue'}
+# /my_rating restores a player from the cold shards
+RATING_COMMANDS = {'register_me', 'delete_me', 'played', 'set_score',
+                   'set_stats_vs', 'my_rating'}
+GLOBAL_COMMANDS = {'rebuild_top', 'migrate_rivals', 'replay_ratings',
+                   'export_state', 'import_state', 'close_season'}
+MENTION_PATTERN = re.compile(r"@([a-zA-Z0-9_]+)")
+EVERYTHING = '*'
+
+
+def serialization_keys(update):
+    """
+    Keys of the objects the update writes, prefixed by its group.
+    Updates sharing a key run one after another, EVERYTHING conflicts
+    with any other writer
+    """
+    command = index.command_of(update)
+    if command in GLOBAL_COMMANDS:
+        return {EVERYTHING}
+    prefix = index.tenants.of(update).prefix
+    if command in QUEUE_COMMANDS:
+        return {f"{prefix}{index.QUEUE_KEY}"}
+    if command not in RATING_COMMANDS:
+        return set()
+
+    message = update['message']
+    keys = {(message.get('from') or {}).get('username')}
+    keys.update(MENTION_PATTERN.findall(message.get('text') or '')[:2])
+    keys.discard(None)
+    if not index.ratings.player_index and index.RATINGS_STORAGE_MODE != 'events':
+        # The leaderboard snapshot is rewritten by every rating change
+        keys.add(index.LEADERBOARD_KEY)
+    return {f"{prefix}{key}" for key in keys}
+
+
+def plan_lanes(updates):
+    """
+    Split the batch into stages of lanes. Lanes of a stage have no keys
+    in common and run in parallel, an update writing EVERYTHING gets a
+    stage of its own
+    """
+    stages = []
+    lanes = []
+    for update in updates:
+        keys = serialization_keys(update)
+        if EVERYTHING in keys:
+            if lanes:
+                stages.append(lanes)
+            stages.append([([update], keys)])
+            lanes = []
+            continue
+
+        merged = [update]
+        for lane in [lane for lane in lanes if lane[1] & keys]:
+            lanes.remove(lane)
+            merged = lane[0] + merged
+            keys = keys | lane[1]
+        lanes.append((merged, keys))
+
+    if lanes:
+        stages.append(lanes)
+    return stages
+
+
+def process_update(update):
+    metrics = index.InvocationMetrics()
+    token = index.current_metrics.set(metrics)
+    try:
+        index.dispatch(update, index.tenants.of(update))
+    except Exception as e:
+        logging.error(f'{e=}')
+        metrics.error = repr(e)
+    finally:
+        index.current_metrics.reset(token)
+        index.emit_metrics(metrics)
+
+
+def run_lane(updates):
+    for update in updates:
+        process_update(update)
+
+
+class PollingRunner:
+    def __init__(self, storage, offset_key, workers, timeout):
+        self.storage = storage
+        self.offset_key = offset_key
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stopping = threading.Event()
+        self.offset = None
+
+    def load_offset(self):
+        try:
+            return json.loads(self.storage.get(self.offset_key))['offset']
+        except Exception as e:
+            return None
+
+    def save_offset(self):
+        self.storage.put(self.offset_key, json.dumps({'offset': self.offset}))
+
+    def stop(self, *args):
+        logging.info('Stopping after the current batch')
+        self.stopping.set()
+
+    def process(self, updates):
+        commands = [update for update in updates
+                    if index.command_of(update) and index.tenants.of(update)]
+        for stage in plan_lanes(commands):
+            futures = [self.executor.submit(run_lane, lane)
+                       for lane, keys in stage]
+            for future in futures:
+                future.result()
+
+    def run(self):
+        self.offset = self.load_offset()
+        while not self.stopping.is_set():
+            try:
+                updates = telebot.apihelper.get_updates(
+                    index.BOT_TOKEN, offset=self.offset,
+                    timeout=self.timeout, allowed_updates=['message'],
+                    long_polling_timeout=self.timeout)
+            except Exception as e:
+                logging.error(f'{e=}')
+                self.stopping.wait(POLLING_RETRY_DELAY)
+                continue
+
+            if not updates:
+                continue
+            self.process(updates)
+            self.offset = updates[-1]['update_id'] + 1
+            self.save_offset()
+
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    runner = PollingRunner(index.storage, POLLING_OFFSET_KEY,
+                           POLLING_WORKERS, POLLING_TIMEOUT)
+    signal.signal(signal.SIGINT, runner.stop)
+    signal.signal(signal.SIGTERM, runner.stop)
+    runner.run()
+
+
+if __name__ == '__main__':
+    main()
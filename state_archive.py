@@ -0,0 +1,53 @@
+# Export and import of the bot's state as one compressed snapshot
+# Every player, rivals, activity and queue object of a group is read in
+# parallel chunks into a gzipped JSON document, or written back from one.
+#
+# Usage: python state_archive.py export [--group CHAT_ID] [--output FILE]
+#        python state_archive.py import [--group CHAT_ID] [--input FILE]
+# Without --output/--input the snapshot object in the bot's bucket is used,
+# the same one /export_state and /import_state work with. --group picks
+# one of the GROUP_IDS groups instead of the default one.
+
+import argparse
+
+import index
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('--group', type=int)
+    parser.add_argument('--output')
+    parser.add_argument('--input')
+    args = parser.parse_args()
+    tenant = index.tenants.get(args.group)
+    archive = tenant.archive
+
+    if args.action == 'export':
+        document = archive.dump()
+        if args.output:
+            with open(args.output, 'wb') as output:
+                output.write(archive.compress(document))
+        else:
+            archive.save(document)
+        print(f"Exported {len(document['objects'])} objects "
+              f"into {args.output or archive.archive_key}")
+        return
+
+    if args.input:
+        with open(args.input, 'rb') as snapshot:
+            document = archive.decompress(snapshot.read())
+    else:
+        document = archive.load()
+    if not document:
+        print("There's no exported snapshot to import")
+        return
+
+    imported = archive.restore(document)
+    tenant.replies.bump('ratings')
+    tenant.replies.bump('queue')
+    print(f"Imported {imported} objects from {args.input or archive.archive_key}")
+
+
+if __name__ == '__main__':
+    main()